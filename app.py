@@ -1,24 +1,99 @@
 # ==============================================================================
 # === app.py (Revised for Multi-Disease Support) ===============================
 # ==============================================================================
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string
+import json
 import os
 import time
-import threading
 import uuid
 import numpy as np
 
-# Import our processing modules
-import fmri_processing
-import entropy_calculator
-import ml_predictor
+# Import our processing modules. The heavy ones (nilearn, nibabel, scipy, antropy, pandas,
+# the joblib models) are imported on first use, so a worker answers '/' and '/status' right away.
+import chunked_upload
+import feature_store
+import job_scheduler
+import job_store
+import result_cache
+import startup
+
+fmri_processing = startup.LazyModule('fmri_processing')
+entropy_calculator = startup.LazyModule('entropy_calculator')
+ml_predictor = startup.LazyModule('ml_predictor')
+checkpoints = startup.LazyModule('checkpoints')
+resources = startup.LazyModule('resources')
 
 app = Flask(__name__)
-jobs = {}
+# Job state shared by every app/worker process (SQLite by default, see NEUROSCOPE_JOB_STORE)
+JOBS = job_store.open_job_store()
+
+# Optional artifact of the processed 4D image: 'nii' (fast, uncompressed), 'nii.gz' or unset (not written).
+# The image is always handed to the entropy stage in memory.
+PROCESSED_IMAGE_FORMAT = os.environ.get('NEUROSCOPE_PROCESSED_IMAGE_FORMAT') or None
+
+# --- Per-job memory: the NiLearn and entropy stages are held to the memory the scheduler admits a job with
+# (NEUROSCOPE_JOB_MEMORY_MB); NEUROSCOPE_FLOAT32=1 runs them in single precision, about half the memory ---
+JOB_MEMORY_BUDGET_MB = job_scheduler.DEFAULT_JOB_MEMORY_MB
+PROCESSING_DTYPE = np.float32 if os.environ.get('NEUROSCOPE_FLOAT32', '0') == '1' else np.float64
+
+# --- Uploads: streamed to uploads/<upload_id>/, hashed on the fly, resumable in chunks ---
+UPLOADS = chunked_upload.UploadManager()
+
+# --- Content-addressed result cache (same inputs + same parameters -> no recomputation) ---
+REPETITION_TIME = 2.0
+RESULT_CACHE = result_cache.ResultCache(
+    cache_dir=os.environ.get('NEUROSCOPE_CACHE_DIR', result_cache.DEFAULT_CACHE_DIR),
+    max_bytes=int(os.environ.get('NEUROSCOPE_CACHE_MAX_MB', 2048)) * 1024 ** 2
+)
+
+# --- Stage checkpoints: a failed or resubmitted job resumes after its last finished stage ---
+CHECKPOINT_DIR = os.environ.get('NEUROSCOPE_CHECKPOINT_DIR', 'checkpoints')
+# Size cap of the checkpoint directory (least recently used checkpoints go first); a job's own
+# NiLearn/entropy checkpoints are deleted once it succeeds, since its result is cached by then
+CHECKPOINT_MAX_BYTES = int(os.environ.get('NEUROSCOPE_CHECKPOINT_MAX_MB', 4096)) * 1024 ** 2
+
+# --- Optional binary feature store: with NEUROSCOPE_FEATURE_STORE=<dir> every job's feature vector is
+# appended there (indexed by job id, cache key and feature plan) instead of writing a per-job entropy_features.csv ---
+FEATURE_STORE_DIR = os.environ.get('NEUROSCOPE_FEATURE_STORE')
+FEATURE_STORE = feature_store.FeatureStore(FEATURE_STORE_DIR) if FEATURE_STORE_DIR else None
+
+# 'models' (default) computes only the (ROI, entropy type) features the requested models read,
+# 'all' the full 1056-feature vector; the feature store keeps the unplanned features as NaN
+FEATURE_PLAN = os.environ.get('NEUROSCOPE_FEATURE_PLAN', 'models')
+
+# --- Preview mode (per job): a provisional prediction from sampled template pairs while the exact entropies run ---
+PREVIEW_PAIR_BUDGET = int(os.environ.get('NEUROSCOPE_PREVIEW_PAIRS', 20000))
+
+# '0' runs fMRIPrep on the uploaded file; otherwise the preprocessed 'fast_check_data' folder is used
+FAST_CHECK_MODE = os.environ.get('NEUROSCOPE_FAST_CHECK', '1') != '0'
+
 
-# --- Load ALL Machine Learning Models at Startup ---
-# This single line replaces the old try/except block.
-ml_predictor.load_all_models()
+def pipeline_parameters():
+    """Every parameter that changes the feature vector; part of the result-cache key."""
+    return {
+        'tr': REPETITION_TIME,
+        'fd_threshold': fmri_processing.FD_THRESHOLD,
+        'low_pass': fmri_processing.LOW_PASS,
+        'high_pass': fmri_processing.HIGH_PASS,
+        'smoothing_fwhm': fmri_processing.SMOOTHING_FWHM,
+        'atlas_radius': entropy_calculator.ATLAS_RADIUS,
+        'roi_low_pass': entropy_calculator.ROI_LOW_PASS,
+        'roi_high_pass': entropy_calculator.ROI_HIGH_PASS,
+        'dtype': np.dtype(PROCESSING_DTYPE).name,
+    }
+
+
+def warm_up():
+    """Eager warm-up: imports every heavy module, loads the models and the atlas/template bundle."""
+    return startup.warm_up(
+        [fmri_processing, entropy_calculator, ml_predictor, checkpoints, resources],
+        [('ML models', ml_predictor.ensure_models_loaded),
+         ('atlas/template bundle', lambda: (resources.get_atlas_coords(), resources.get_mni152_template_3mm()))])
+
+
+# --- Machine Learning Models: loaded by the first prediction, or here with NEUROSCOPE_EAGER_STARTUP=1 ---
+if startup.EAGER_STARTUP:
+    warm_up()
 
 # --- Redesigned HTML Template (with enabled dropdown) ---
 HTML_TEMPLATE = '''
@@ -78,17 +153,22 @@ HTML_TEMPLATE = '''
                     <option value="scz" selected>Schizophrenia vs. Healthy</option>
                     <option value="adhd">ADHD vs. Healthy</option>
                     <option value="bpd">Bipolar vs. Healthy</option>
+                    <option value="all">All available models</option>
                 </select>
+                <label style="margin-top: 10px;"><input type="checkbox" id="previewToggle"> Quick preview while the exact analysis runs</label>
             </div>
             <div class="upload-area" onclick="document.getElementById('fileInput').click()"><h3>📁 Select fMRI File</h3><p>Click here to choose a preprocessed .nii.gz file</p><input type="file" id="fileInput" style="display: none;"></div>
         </div>
-        <div id="processingSection" class="processing-section card"><div class="status-text" id="statusText">Initializing...</div><div class="progress-bar"><div class="progress-fill" id="progressFill"></div></div><div class="progress-text" id="progressText">0%</div></div>
+        <div id="processingSection" class="processing-section card"><div class="status-text" id="statusText">Initializing...</div><div class="progress-bar"><div class="progress-fill" id="progressFill"></div></div><div class="progress-text" id="progressText">0%</div><div class="progress-text" id="previewText"></div></div>
         <div id="resultsSection" class="results-section card">
-            <div class="results-header"><h4>Primary Finding</h4><span id="primaryDiagnosis"></span></div>
-            <div class="results-grid">
-                <div class="result-bar"><div class="label" id="class0Label">Healthy</div><div class="value" id="class0ProbValue">0%</div></div>
-                <div class="result-bar"><div class="label" id="class1Label">Disease</div><div class="value" id="class1ProbValue">0%</div></div>
+            <div id="singleResult">
+                <div class="results-header"><h4>Primary Finding</h4><span id="primaryDiagnosis"></span></div>
+                <div class="results-grid">
+                    <div class="result-bar"><div class="label" id="class0Label">Healthy</div><div class="value" id="class0ProbValue">0%</div></div>
+                    <div class="result-bar"><div class="label" id="class1Label">Disease</div><div class="value" id="class1ProbValue">0%</div></div>
+                </div>
             </div>
+            <div id="multiResults"></div>
             <button class="btn" onclick="resetDemo()" style="margin-top: 30px;">Analyze Another File</button>
         </div>
     </div>
@@ -103,19 +183,89 @@ HTML_TEMPLATE = '''
             }
         });
 
+        // Chunked, resumable upload: a failed chunk is retried from the offset the server reports
+        const CHUNK_RETRIES = 5;
+        // A full job queue answers 'complete' with 429; the upload stays on the server and 'complete' is retried
+        const COMPLETE_RETRIES = 20;
+
+        function showUploadProgress(sent, total) {
+            const percent = total ? Math.floor(sent * 100 / total) : 100;
+            document.getElementById('progressFill').style.width = percent + '%';
+            document.getElementById('progressText').textContent = percent + '%';
+            document.getElementById('statusText').textContent = 'Uploading fMRI file...';
+        }
+
+        async function postJson(url, body) {
+            const response = await fetch(url, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(body) });
+            return { response, data: await response.json() };
+        }
+
         async function uploadFile(file) {
-            const formData = new FormData();
-            formData.append('file', file);
             // --- NEW: Send the selected disease to the backend ---
             const selectedDisease = document.getElementById('diseaseSelect').value;
-            formData.append('disease', selectedDisease);
+            const preview = document.getElementById('previewToggle').checked;
 
             try {
-                const response = await fetch('/upload', { method: 'POST', body: formData });
-                const data = await response.json();
+                let { response, data } = await postJson('/uploads', { filename: file.name, size: file.size, disease: selectedDisease, preview: preview });
+                if (!response.ok) throw new Error(data.error);
+                const uploadId = data.upload_id;
+                const chunkSize = data.chunk_size;
+                let offset = data.offset;
+                let failures = 0;
+
+                while (offset < file.size) {
+                    showUploadProgress(offset, file.size);
+                    try {
+                        response = await fetch(`/uploads/${uploadId}?offset=${offset}`, {
+                            method: 'PUT', headers: { 'Content-Type': 'application/octet-stream' },
+                            body: file.slice(offset, offset + chunkSize)
+                        });
+                        data = await response.json();
+                    } catch (error) {
+                        // Network error: ask the server how much arrived and continue from there
+                        if (++failures > CHUNK_RETRIES) throw error;
+                        await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+                        const status = await fetch(`/uploads/${uploadId}`);
+                        offset = (await status.json()).offset;
+                        continue;
+                    }
+                    if (response.ok || response.status === 409) { offset = data.offset; failures = 0; }
+                    else if (response.status >= 500 && ++failures <= CHUNK_RETRIES) { await new Promise(resolve => setTimeout(resolve, 1000 * failures)); }
+                    else throw new Error(data.error);
+                }
+                showUploadProgress(file.size, file.size);
+
+                for (let attempt = 1; ; attempt++) {
+                    ({ response, data } = await postJson(`/uploads/${uploadId}/complete`, {}));
+                    if (response.status !== 429 || attempt > COMPLETE_RETRIES) break;
+                    const retryAfter = parseInt(response.headers.get('Retry-After') || data.retry_after, 10) || 30;
+                    document.getElementById('statusText').textContent = `Server busy, queueing again in ${retryAfter} s...`;
+                    await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+                }
+                if (!response.ok) { alert('Upload failed: ' + data.error); resetDemo(); return; }
                 currentJobId = data.job_id;
-                checkStatus();
-            } catch (error) { alert('Upload failed: ' + error.message); }
+                watchJob();
+            } catch (error) { alert('Upload failed: ' + error.message); resetDemo(); }
+        }
+
+        // Returns true once the job has finished
+        function handleStatus(data) {
+            updateProgress(data.progress, data.status, data.queue_position);
+            if (data.preview && data.status !== 'completed') showPreview(data.preview);
+            if (data.status === 'completed') { showResults(data.results); return true; }
+            if (data.status === 'error') { alert('Processing failed: ' + data.error); return true; }
+            return false;
+        }
+
+        // Progress is pushed over Server-Sent Events; polling /status is the fallback
+        function watchJob() {
+            if (!window.EventSource) { checkStatus(); return; }
+            const jobId = currentJobId;
+            const source = new EventSource(`/events/${jobId}`);
+            source.onmessage = (event) => { if (handleStatus(JSON.parse(event.data))) source.close(); };
+            source.addEventListener('gone', () => { source.close(); alert('This job is no longer available.'); resetDemo(); });
+            source.addEventListener('reconnect', () => { source.close(); if (currentJobId === jobId) watchJob(); });
+            source.onerror = () => { source.close(); if (currentJobId === jobId) checkStatus(); };
         }
 
         async function checkStatus() {
@@ -123,25 +273,73 @@ HTML_TEMPLATE = '''
             try {
                 const response = await fetch(`/status/${currentJobId}`);
                 const data = await response.json();
-                updateProgress(data.progress, data.status);
-                if (data.status === 'completed') { showResults(data.results); }
-                else if (data.status === 'error') { alert('Processing failed: ' + data.error); }
-                else { setTimeout(checkStatus, 1500); }
+                if (!handleStatus(data)) { setTimeout(checkStatus, 1500); }
             } catch (error) { console.error('Status check failed:', error); setTimeout(checkStatus, 2000); }
         }
 
-        function updateProgress(progress, status) {
+        function updateProgress(progress, status, queuePosition) {
             document.getElementById('progressFill').style.width = progress + '%';
             document.getElementById('progressText').textContent = Math.round(progress) + '%';
-            const statusMap = { 'preprocessing': 'Analyzing fMRI data structure...','custom_processing': 'Applying advanced signal processing (NiLearn)...','entropy': 'Extracting statistical features (Entropy)...','prediction': 'Running diagnostic prediction model...','completed': 'Analysis complete!'};
+            const statusMap = { 'fmriprep': 'Preprocessing with fMRIPrep...','queued': queuePosition ? `Waiting in queue (position ${queuePosition})...` : 'Waiting in queue...','preprocessing': 'Analyzing fMRI data structure...','custom_processing': 'Applying advanced signal processing (NiLearn)...','entropy': 'Extracting statistical features (Entropy)...','prediction': 'Running diagnostic prediction model...','completed': 'Analysis complete!'};
             document.getElementById('statusText').textContent = statusMap[status] || 'Processing...';
         }
 
         // --- NEW: Dynamic results display ---
+        // --- Provisional finding from sampled entropies, replaced by the exact result when it arrives ---
+        function showPreview(preview) {
+            const summarize = (result) => result.error ? 'not available' :
+                `${result.primary_diagnosis} (${result.probabilities[result.primary_diagnosis.toLowerCase()].toFixed(1)}%)`;
+            const results = preview.results;
+            const text = results.diseases
+                ? Object.entries(results.diseases).map(([key, result]) => `${key.toUpperCase()}: ${summarize(result)}`).join(' · ')
+                : summarize(results);
+            document.getElementById('previewText').textContent = `Provisional: ${text} (refining...)`;
+        }
+
+        // --- Several diseases from one scan: one block per model ---
+        function showMultiResults(diseases) {
+            const container = document.getElementById('multiResults');
+            container.innerHTML = '';
+            for (const [key, result] of Object.entries(diseases)) {
+                const block = document.createElement('div');
+                block.style.marginBottom = '30px';
+                const header = document.createElement('div');
+                header.className = 'results-header';
+                header.innerHTML = '<h4></h4><span></span>';
+                header.querySelector('h4').textContent = key.toUpperCase();
+                block.appendChild(header);
+                if (result.error) {
+                    header.querySelector('span').textContent = 'Not available';
+                    container.appendChild(block);
+                    continue;
+                }
+                header.querySelector('span').textContent = result.primary_diagnosis;
+                const grid = document.createElement('div');
+                grid.className = 'results-grid';
+                result.class_names.forEach((name, idx) => {
+                    const bar = document.createElement('div');
+                    bar.className = 'result-bar';
+                    bar.innerHTML = '<div class="label"></div><div class="value"></div>';
+                    bar.querySelector('.label').textContent = name;
+                    const value = bar.querySelector('.value');
+                    value.textContent = result.probabilities[name.toLowerCase()].toFixed(1) + '%';
+                    value.style.color = idx === 0 ? '#10b981' : '#ef4444';
+                    grid.appendChild(bar);
+                });
+                block.appendChild(grid);
+                container.appendChild(block);
+            }
+        }
+
         function showResults(results) {
             document.getElementById('processingSection').style.display = 'none';
             document.getElementById('resultsSection').style.display = 'block';
 
+            const isMulti = Boolean(results.diseases);
+            document.getElementById('singleResult').style.display = isMulti ? 'none' : 'block';
+            document.getElementById('multiResults').style.display = isMulti ? 'block' : 'none';
+            if (isMulti) { showMultiResults(results.diseases); return; }
+
             const [class0Name, class1Name] = results.class_names;
             const class0Key = class0Name.toLowerCase();
             const class1Key = class1Name.toLowerCase();
@@ -157,6 +355,7 @@ HTML_TEMPLATE = '''
             document.getElementById('resultsSection').style.display = 'none';
             document.getElementById('uploadCard').style.display = 'block';
             document.getElementById('fileInput').value = '';
+            document.getElementById('previewText').textContent = '';
             currentJobId = null;
         }
     </script>
@@ -170,49 +369,272 @@ def index():
     return render_template_string(HTML_TEMPLATE)
 
 
+def validate_job_options(disease_key, priority):
+    """Checks the job options; disease_key may be one key, several (comma-separated) or 'all'."""
+    try:
+        ml_predictor.parse_disease_keys(disease_key)
+    except ValueError as e:
+        raise chunked_upload.UploadError(str(e))
+    if priority not in job_scheduler.PRIORITIES:
+        raise chunked_upload.UploadError(f"Unknown priority '{priority}'")
+
+
+def parse_flag(value):
+    return str(value).strip().lower() in ('1', 'true', 'on', 'yes')
+
+
+def enqueue_job(job_id, filepath, upload_sha256, disease_key, priority, upload_id, preview=False,
+                resumable=False):
+    """
+    Creates the job for a finished upload and queues it; 429 when the queue is saturated.
+    On 429 only the job row is dropped: a resumable (chunked) upload is kept, so the client
+    retries POST /uploads/<id>/complete after Retry-After. A single-request upload cannot be
+    retried that way and is deleted.
+    """
+    JOBS.create(job_id, {'status': 'queued', 'progress': 0, 'filepath': filepath, 'upload_sha256': upload_sha256})
+
+    # Everything the worker needs goes in the job's args: it runs in another process and never reads
+    # the job store (a memory:// store is empty there). A saturated queue answers 429 instead of piling up jobs
+    try:
+        position = SCHEDULER.submit(job_id, (disease_key, filepath, upload_sha256, preview), priority=priority)
+    except job_scheduler.QueueFull as e:
+        JOBS.delete(job_id)
+        if not resumable:
+            UPLOADS.delete(upload_id)
+        return (jsonify({'error': str(e), 'queue_depth': e.depth, 'retry_after': e.retry_after,
+                         'upload_kept': resumable}), 429,
+                {'Retry-After': str(e.retry_after)})
+    return jsonify({'job_id': job_id, 'message': 'Upload successful, job queued', 'queue_position': position,
+                    'sha256': upload_sha256})
+
+
+@app.errorhandler(chunked_upload.UploadError)
+def upload_error(e):
+    return jsonify({'error': str(e), **e.details}), e.status_code
+
+
 # --- NEW: /upload route now accepts the selected disease ---
+# Single-request upload; large files should use the chunked /uploads API below
 @app.route('/upload', methods=['POST'])
 def upload_file():
     try:
         if 'file' not in request.files: return jsonify({'error': 'No file uploaded'}), 400
         file = request.files['file']
         disease_key = request.form.get('disease', 'scz')  # Default to 'scz' if not provided
+        priority = request.form.get('priority', 'normal')
+        preview = parse_flag(request.form.get('preview', ''))
         if file.filename == '': return jsonify({'error': 'No file selected'}), 400
+        validate_job_options(disease_key, priority)
 
-        job_id = str(uuid.uuid4())
-        os.makedirs('uploads', exist_ok=True)
-        filepath = os.path.join('uploads', file.filename)
-        file.save(filepath)
-
-        jobs[job_id] = {'status': 'preprocessing', 'progress': 0, 'filepath': filepath}
-
-        # Pass the disease_key to the processing thread
-        thread = threading.Thread(target=process_pipeline, args=(job_id, disease_key))
-        thread.daemon = True
-        thread.start()
-        return jsonify({'job_id': job_id, 'message': 'Upload successful, processing started'})
+        # Each upload gets its own directory, so identical filenames of concurrent jobs never collide
+        filepath, upload_sha256, upload = UPLOADS.save_stream(file.filename, file.stream)
+        return enqueue_job(str(uuid.uuid4()), filepath, upload_sha256, disease_key, priority, upload['upload_id'],
+                           preview=preview)
+    except chunked_upload.UploadError:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+# --- Chunked, resumable uploads ---
+# POST /uploads {filename, size, disease, priority, preview} -> upload_id, chunk_size
+# PUT /uploads/<id>?offset=N (raw bytes) -> new offset; 409 + current offset if N is not where the upload stands
+# GET /uploads/<id> -> offset to resume from
+# POST /uploads/<id>/complete {sha256 (optional)} -> job_id; 429 + Retry-After when the queue is full
+#   (the upload is kept, so the same call is simply retried later)
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    params = request.get_json(silent=True) or {}
+    disease_key = params.get('disease', 'scz')
+    priority = params.get('priority', 'normal')
+    validate_job_options(disease_key, priority)
+    upload = UPLOADS.create(params.get('filename'), params.get('size'),
+                            metadata={'disease': disease_key, 'priority': priority,
+                                      'preview': parse_flag(params.get('preview', False))})
+    return jsonify(upload), 201
+
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    return jsonify(UPLOADS.status(upload_id))
+
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    offset = request.args.get('offset', request.headers.get('Upload-Offset'))
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        raise chunked_upload.UploadError("The chunk offset is required")
+    return jsonify(UPLOADS.write_chunk(upload_id, offset, request.stream, request.content_length))
+
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    params = request.get_json(silent=True) or {}
+    filepath, upload_sha256, upload = UPLOADS.complete(upload_id, expected_sha256=params.get('sha256'))
+    # The job id is the upload id, so a retried 'complete' does not start a second job
+    existing = JOBS.get(upload_id)
+    if existing is not None:
+        return jsonify({'job_id': upload_id, 'message': 'Job already queued', 'sha256': upload_sha256})
+    metadata = upload['metadata']
+    return enqueue_job(upload_id, filepath, upload_sha256, metadata['disease'], metadata['priority'], upload_id,
+                       preview=metadata.get('preview', False), resumable=True)
+
+
 # --- NEW: process_pipeline now accepts the disease_key ---
-def process_pipeline(job_id, disease_key):
+def prediction_stage(disease_keys):
+    """
+    The ML prediction as a stage; the model files' hashes are part of its key. It takes
+    milliseconds, so it is not checkpointed.
+    One disease keeps the single-result format, several give {'diseases': {key: result}}.
+    """
+    model_hashes = {}
+    for key in disease_keys:
+        model_path = ml_predictor.DISEASE_CONFIG[key]['model_path']
+        model_hashes[key] = result_cache.file_sha256(model_path) if os.path.exists(model_path) else None
+    predict = lambda features: predict_diseases(features, disease_keys)
+    return checkpoints.Stage('prediction', {'diseases': model_hashes}, predict, 'json', checkpoint=False)
+
+
+def predict_diseases(features, disease_keys):
+    """Same result format as the prediction stage: single disease as before, several combined."""
+    if len(disease_keys) == 1:
+        return ml_predictor.run_ml_prediction(features, disease_keys[0])
+    return ml_predictor.run_multi_prediction(features, disease_keys)
+
+
+def post_preview(job_id, disease_keys, timeseries, feature_indices):
+    """Provisional prediction from sampled template pairs; the exact entropies run right after."""
+    started = time.time()
+    timeseries_std, timeseries_raw = timeseries
+    features, ci_low, ci_high = entropy_calculator.preview_entropy_features(
+        timeseries_std, timeseries_raw, pair_budget=PREVIEW_PAIR_BUDGET, feature_indices=feature_indices)
+    half_widths = (ci_high - ci_low) / 2
+    n_rois = entropy_calculator.N_ROIS
+    ci_summary = {}
+    for k, kind in enumerate(entropy_calculator.ENTROPY_TYPES):
+        block = half_widths[k * n_rois:(k + 1) * n_rois]
+        block = block[np.isfinite(block)]
+        if block.size:
+            ci_summary[kind] = {'median_half_width': float(np.median(block)), 'max_half_width': float(block.max())}
+    update_job(job_id, preview={
+        'results': predict_diseases(features, disease_keys),
+        'pair_budget': PREVIEW_PAIR_BUDGET,
+        'confidence': entropy_calculator.PREVIEW_CONFIDENCE,
+        'ci': ci_summary,
+        'seconds': round(time.time() - started, 3),
+    })
+    print(f"👀 Preview for job {job_id} posted after {time.time() - started:.1f} s, refining to the exact result.")
+
+
+# Progress range (%) of each pipeline phase; finer steps inside a phase are interpolated
+PROGRESS_RANGES = {'fmriprep': (2, 10), 'custom_processing': (10, 40), 'entropy': (40, 80)}
+
+
+def phase_progress(job_id, status):
+    """progress(stage, done, total) callback that reports a stage of the given phase via update_job."""
+    low, high = PROGRESS_RANGES[status]
+
+    def progress(stage, done, total):
+        update_job(job_id, status=status, stage=stage, progress=round(low + (high - low) * done / total, 1))
+
+    return progress
+
+
+def is_cacheable(features, feature_indices):
+    """Only a non-empty plan whose planned features are all numbers goes into the result cache."""
+    features = np.asarray(features, dtype=np.float64)
+    planned = features if feature_indices == 'all' else features[np.asarray(feature_indices, dtype=np.intp)]
+    return planned.size > 0 and not np.isnan(planned).any()
+
+
+def process_pipeline(job_id, disease_key, uploaded_filepath, upload_sha256=None, preview=False):
+    """The whole job, run in a worker process; it only writes the job store (via update_job), never reads it."""
     try:
-        print(f"🚀 RUNNING IN FAST CHECK MODE for disease: {disease_key.upper()} 🚀")
-        preprocessed_data_dir = os.path.abspath('fast_check_data')
-        jobs[job_id].update({'status': 'custom_processing', 'progress': 10})
+        # One extraction serves every requested model: 'scz', 'scz,adhd' or 'all' (every loaded model)
+        disease_keys = ml_predictor.resolve_disease_keys(disease_key)
+        # Raises now, before fMRIPrep and the entropy stage, if a requested model is not loaded
+        model_features = ml_predictor.required_feature_indices(disease_keys)
+        update_job(job_id, diseases=disease_keys)
+        if FAST_CHECK_MODE:
+            print(f"🚀 RUNNING IN FAST CHECK MODE for disease: {', '.join(disease_keys).upper()} 🚀")
+            preprocessed_data_dir = os.path.abspath('fast_check_data')
+        else:
+            # fMRIPrep checkpoints are chained from the uploaded file's content hash,
+            # the one computed while the upload streamed in (no second pass over the file)
+            upload_hash = upload_sha256 or result_cache.file_sha256(uploaded_filepath)
+            upload_chain = checkpoints.PipelineCheckpoints(upload_hash, root=CHECKPOINT_DIR,
+                                                           max_bytes=CHECKPOINT_MAX_BYTES)
+            fmriprep_stages = fmri_processing.build_fmriprep_stages(job_id)
+            fmriprep_progress = phase_progress(job_id, 'fmriprep')
+            update_job(job_id, status='fmriprep', stage='fmriprep', progress=2)
+            preprocessed_data_dir = checkpoints.run_stages(
+                fmriprep_stages, lambda: uploaded_filepath, checkpoints=upload_chain,
+                on_stage_done=lambda name: fmriprep_progress(
+                    name, [stage.name for stage in fmriprep_stages].index(name) + 1, len(fmriprep_stages)))
+        update_job(job_id, status='custom_processing', stage='loading', progress=10)
+
+        # Only the features the requested models read, unless FEATURE_PLAN is 'all'
+        feature_indices = model_features if FEATURE_PLAN == 'models' else 'all'
 
-        final_processed_file = fmri_processing.run_nilearn_processing(preprocessed_data_dir, job_id)
-        jobs[job_id].update({'status': 'entropy', 'progress': 40})
+        # The cache key covers the files the pipeline actually reads plus all processing parameters
+        input_files = fmri_processing.find_input_files(preprocessed_data_dir)
+        input_hashes = [result_cache.file_sha256(p) for p in input_files]
+        cache_key = result_cache.make_cache_key(input_hashes, pipeline_parameters())
+        # A partial feature vector is cached under its own key; a cached full vector serves any plan
+        features_key = cache_key if feature_indices == 'all' else result_cache.make_cache_key(
+            input_hashes, dict(pipeline_parameters(), features=feature_indices))
+        cached = RESULT_CACHE.get(cache_key)
+        # The features the vector holds: a cached full vector has every one of them
+        computed_features = 'all' if cached is not None else feature_indices
+        if cached is None and features_key != cache_key:
+            cached = RESULT_CACHE.get(features_key)
+        # Stage checkpoints hang off the same key, so a partially finished run of these inputs is resumed
+        chain = checkpoints.PipelineCheckpoints(cache_key, root=CHECKPOINT_DIR, max_bytes=CHECKPOINT_MAX_BYTES)
 
-        entropy_features = entropy_calculator.calculate_entropy_features(final_processed_file)
-        jobs[job_id].update({'status': 'prediction', 'progress': 80})
+        if cached is not None:
+            print(f"⚡ Cache hit ({cache_key[:12]}), skipping NiLearn and entropy stages.")
+            entropy_features = cached['features']
+        else:
+            final_processed_img = fmri_processing.run_nilearn_processing(
+                preprocessed_data_dir, job_id, tr=REPETITION_TIME, dtype=PROCESSING_DTYPE,
+                memory_budget_mb=JOB_MEMORY_BUDGET_MB, save_output=PROCESSED_IMAGE_FORMAT,
+                return_img=True, checkpoints=chain, progress=phase_progress(job_id, 'custom_processing'))
+            update_job(job_id, status='entropy', stage='roi_extraction', progress=40)
 
-        # Pass the disease_key to the prediction function
-        results = ml_predictor.run_ml_prediction(entropy_features, disease_key)
+            entropy_progress = phase_progress(job_id, 'entropy')
+            entropy_stages = entropy_calculator.build_entropy_stages(
+                t_r=REPETITION_TIME, dtype=PROCESSING_DTYPE, memory_budget_mb=JOB_MEMORY_BUDGET_MB,
+                output_dir=None if FEATURE_STORE is not None else fmri_processing.get_nilearn_output_dir(job_id),
+                progress=lambda done, total: entropy_progress(f"entropy ROI chunk {done}/{total}", done, total),
+                feature_indices=feature_indices)
+            roi_stage, entropy_stage = entropy_stages
+            timeseries = chain.run([roi_stage], lambda: final_processed_img)
+            if preview:
+                try:
+                    post_preview(job_id, disease_keys, timeseries, feature_indices)
+                except Exception as e:
+                    print(f"⚠️ Preview for job {job_id} failed, continuing with the exact run: {e}")
+            entropy_features, timeseries_std, timeseries_raw = chain.run([entropy_stage], lambda: timeseries)
+            if is_cacheable(entropy_features, feature_indices):
+                RESULT_CACHE.put(features_key, entropy_features, timeseries_std, timeseries_raw,
+                                 metadata={'job_id': job_id, 'params': pipeline_parameters(),
+                                           'features': feature_indices})
+            else:
+                print(f"⚠️ Job {job_id}: planned features contain NaN, not caching them.")
+        if FEATURE_STORE is not None:
+            FEATURE_STORE.append(entropy_features, subject=os.path.basename(uploaded_filepath), job_id=job_id,
+                                 content_hash=cache_key, columns=computed_features)
+        update_job(job_id, status='prediction', stage='prediction', progress=80, cache_hit=cached is not None)
 
-        time.sleep(2)
-        jobs[job_id].update({'status': 'completed', 'progress': 100, 'results': results})
+        # Pass the disease keys to the prediction function
+        results = chain.run([prediction_stage(disease_keys)], lambda: entropy_features)
+
+        if cached is None:
+            time.sleep(2)  # Only for the final progress animation; a cache hit returns right away
+        update_job(job_id, status='completed', stage=None, progress=100, results=results)
+        chain.discard()
 
     except Exception as e:
         import traceback
@@ -221,13 +643,93 @@ def process_pipeline(job_id, disease_key):
         print("=" * 80)
         traceback.print_exc()
         print("=" * 80 + "\n");
-        jobs[job_id].update({'status': 'error', 'error': str(e)})
+        update_job(job_id, status='error', error=str(e))
+
+
+def update_job(job_id, **fields):
+    """Progress/status of a job; works from the worker processes too."""
+    SCHEDULER.update(job_id, **fields)
+
+
+# --- Bounded worker pool: NEUROSCOPE_WORKERS processes, NEUROSCOPE_MAX_QUEUE waiting jobs ---
+# Job processes are forked from a fork server that imported the heavy modules once, so a job
+# (e.g. a result-cache hit) does not pay the NiLearn/entropy imports again
+SCHEDULER = job_scheduler.JobScheduler(
+    target=process_pipeline, on_update=JOBS.update,
+    preload=['fmri_processing', 'entropy_calculator', 'ml_predictor', 'checkpoints', 'resources'])
+
+
+@app.route('/startup-profile')
+def startup_profile():
+    return jsonify(startup.report())
+
+
+def job_status(job_id):
+    """The job's state plus its queue information, or None for an unknown job."""
+    status = JOBS.get(job_id)
+    if status is None:
+        return None
+    queue_info = SCHEDULER.queue_info(job_id)
+    if queue_info['queue_position'] is None:
+        del queue_info['queue_position']  # queued by another app process, or finished: keep the stored value
+    status.update(queue_info)
+    if status.get('status') == 'queued' and 'submitted_at' in status:
+        status['wait_seconds'] = round(time.time() - status['submitted_at'], 3)
+    return status
 
 
 @app.route('/status/<job_id>')
 def get_status(job_id):
-    if job_id not in jobs: return jsonify({'error': 'Job not found'}), 404
-    return jsonify(jobs[job_id])
+    status = job_status(job_id)
+    if status is None: return jsonify({'error': 'Job not found'}), 404
+    return jsonify(status)
+
+
+# --- Server-Sent Events: pushes every change of the job instead of the page polling /status ---
+# Each open stream holds one server thread while it waits for the job's next write (woken directly by
+# JOBS.update in this process, see JobStore.wait_for_update). Serve the app with a threaded or async
+# worker (e.g. gunicorn --worker-class gthread --threads 16, or gevent), never plain sync workers,
+# where every open page would occupy a whole worker. Streams end after SSE_MAX_STREAM_SECONDS with a
+# 'reconnect' event (the page opens a new one), which bounds how long one request holds a thread.
+SSE_KEEPALIVE_SECONDS = 15
+SSE_QUEUED_REFRESH_SECONDS = 5
+SSE_MAX_STREAM_SECONDS = int(os.environ.get('NEUROSCOPE_SSE_MAX_SECONDS', 300))
+
+
+@app.route('/events/<job_id>')
+def job_events(job_id):
+    version = JOBS.version(job_id)
+    if version is None: return jsonify({'error': 'Job not found'}), 404
+
+    def stream():
+        nonlocal version
+        closes_at = time.time() + SSE_MAX_STREAM_SECONDS
+        yield "retry: 3000\n\n"
+        while True:
+            status = job_status(job_id)
+            if status is None:
+                yield 'event: gone\ndata: {}\n\n'
+                return
+            yield f"data: {json.dumps(status, separators=(',', ':'), default=float)}\n\n"
+            if status.get('status') in job_store.FINISHED_STATUSES:
+                return
+            # Wait for the next write to the job; a comment line keeps proxies from closing an idle stream.
+            # A queued job's position changes without a write to it, so that is re-sent periodically.
+            queued = status.get('status') == 'queued'
+            while True:
+                remaining = closes_at - time.time()
+                if remaining <= 0:
+                    yield 'event: reconnect\ndata: {}\n\n'  # the page opens a new stream
+                    return
+                new_version = JOBS.wait_for_update(job_id, version, timeout=min(
+                    remaining, SSE_QUEUED_REFRESH_SECONDS if queued else SSE_KEEPALIVE_SECONDS))
+                if new_version != version or queued:
+                    version = new_version
+                    break
+                yield ": keep-alive\n\n"
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 if __name__ == '__main__':
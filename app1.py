@@ -5,30 +5,48 @@ import time
 import threading
 import uuid
 import numpy as np
-import joblib  # Using joblib to load our trained model
 
-# Import our processing modules
-import fmri_processing
-import entropy_calculator
-import ml_predictor
+# Import our processing modules (heavy ones lazily, on first use; see startup.py)
+import startup
+
+fmri_processing = startup.LazyModule('fmri_processing')
+entropy_calculator = startup.LazyModule('entropy_calculator')
+joblib = startup.LazyModule('joblib')  # Using joblib to load our trained model
 
 app = Flask(__name__)
 
 # Simple in-memory job storage
 jobs = {}
 
-ml_predictor.load_all_models()
-
 # --- NEW: Load the Machine Learning Model ---
 # Load your trained Healthy vs. SCZ model.
 # Make sure this file is in the same directory as app.py
-try:
-    ML_MODEL = joblib.load("model_healthy_vs_scz.joblib")
-    DIAGNOSES = ['Healthy', 'Schizophrenia']
-    print("✅ Healthy vs. SCZ model loaded successfully.")
-except FileNotFoundError:
-    ML_MODEL = None
-    print("🚨 WARNING: 'model_healthy_vs_scz.joblib' not found. Real predictions will fail.")
+DIAGNOSES = ['Healthy', 'Schizophrenia']
+ML_MODEL = None
+_model_lock = threading.Lock()
+
+
+def get_ml_model():
+    """Loads the Healthy vs. SCZ model on first use and keeps it for the process lifetime."""
+    global ML_MODEL
+    with _model_lock:
+        if ML_MODEL is None:
+            try:
+                with startup.timed('model', 'model_healthy_vs_scz.joblib'):
+                    ML_MODEL = joblib.load("model_healthy_vs_scz.joblib")
+                print("✅ Healthy vs. SCZ model loaded successfully.")
+            except FileNotFoundError:
+                print("🚨 WARNING: 'model_healthy_vs_scz.joblib' not found. Real predictions will fail.")
+    return ML_MODEL
+
+
+def warm_up():
+    """Eager warm-up: imports the heavy modules and loads the model."""
+    return startup.warm_up([fmri_processing, entropy_calculator, joblib], [('ML model', get_ml_model)])
+
+
+if startup.EAGER_STARTUP:
+    warm_up()
 
 # ==============================================================================
 # === NEW REDESIGNED HTML TEMPLATE =============================================
@@ -344,14 +362,15 @@ def run_ml_prediction(features):
     """
     Runs the real binary classification model.
     """
-    if ML_MODEL is None:
+    ml_model = get_ml_model()
+    if ml_model is None:
         raise RuntimeError("ML Model is not loaded. Cannot perform prediction.")
 
     # Reshape the 1D feature array into a 2D array, as scikit-learn expects
     features_2d = features.reshape(1, -1)
 
     # Get the probabilities for [Class 0, Class 1] (e.g., [Healthy, SCZ])
-    probabilities = ML_MODEL.predict_proba(features_2d)[0]
+    probabilities = ml_model.predict_proba(features_2d)[0]
 
     # Get the primary diagnosis by finding the index of the highest probability
     max_idx = np.argmax(probabilities)
@@ -433,6 +452,11 @@ def process_pipeline(job_id):
         jobs[job_id].update({'status': 'error', 'error': str(e)})
 
 
+@app.route('/startup-profile')
+def startup_profile():
+    return jsonify(startup.report())
+
+
 @app.route('/status/<job_id>')
 def get_status(job_id):
     if job_id not in jobs:
@@ -0,0 +1,178 @@
+# ==============================================================================
+# === checkpoints.py (Stage-level checkpointing for resumable jobs) ============
+# ==============================================================================
+import hashlib
+import json
+import os
+import threading
+from collections import namedtuple
+
+import nibabel as nib
+import numpy as np
+
+from result_cache import PIPELINE_VERSION
+
+DEFAULT_CHECKPOINT_DIR = 'checkpoints'
+# Total size of the checkpoint directory; beyond it the least recently used checkpoints are deleted
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+# name: stage name, params: JSON-serializable parameters, compute: fn(previous value) -> value,
+# kind: how the value is stored ('image', 'arrays', 'json' or 'path'),
+# checkpoint: False for stages that are cheaper to recompute than to write (their key still chains)
+Stage = namedtuple('Stage', ['name', 'params', 'compute', 'kind', 'checkpoint'], defaults=(True,))
+
+# Images and arrays are written compressed (a 4D float image is several GB uncompressed)
+_EXTENSIONS = {'image': '.nii.gz', 'arrays': '.npz', 'json': '.json', 'path': '.json'}
+
+
+def chain_key(parent_key, stage_name, params):
+    """A stage's key hashes its parent's key, its name, its parameters and PIPELINE_VERSION."""
+    payload = json.dumps({'parent': parent_key, 'stage': stage_name, 'params': params,
+                          'version': PIPELINE_VERSION}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class PipelineCheckpoints:
+    """
+    Checkpoints of one job's stages, chained from the content hash of its inputs.
+
+    Since every key depends only on the input hash and the parameters of the stages
+    before it, all keys of a stage list are known up front: run() looks for the last
+    stage with a valid checkpoint, loads only that one and computes the rest, saving
+    each result. A retried or resubmitted job with the same inputs and parameters
+    therefore resumes where the previous attempt stopped.
+
+    Only stages with checkpoint=True are written. Like ResultCache, a load refreshes
+    the checkpoint's mtime and every save deletes the least recently used files once
+    the directory is over max_bytes; discard() removes this chain's checkpoints when
+    the job no longer needs them (e.g. it succeeded and its result is cached).
+    """
+
+    def __init__(self, input_key, root=DEFAULT_CHECKPOINT_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.key = input_key
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self._paths = []  # checkpoint files of this chain, for discard()
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key, kind):
+        return os.path.join(self.root, key[:2], key + _EXTENSIONS[kind])
+
+    def _load(self, key, kind):
+        path = self._path(key, kind)
+        if not os.path.exists(path):
+            return None
+        try:
+            os.utime(path)  # LRU: mark as recently used
+            if kind == 'image':
+                # Read now: a lazily loaded file could be evicted before the next stage reads it
+                image = nib.load(path)
+                return nib.Nifti1Image(np.asanyarray(image.dataobj), image.affine, image.header)
+            if kind == 'arrays':
+                with np.load(path, allow_pickle=False) as saved:
+                    return tuple(saved[f'arr_{i}'] for i in range(len(saved.files)))
+            with open(path) as f:
+                value = json.load(f)
+            if kind == 'path' and not os.path.exists(value):
+                return None  # the directory the checkpoint points to is gone
+            return value
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable checkpoint {path}: {e}")
+            return None
+
+    def _save(self, key, kind, value):
+        path = self._path(key, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ext = _EXTENSIONS[kind]  # kept last (also the full '.nii.gz'), nibabel picks the format from it
+        tmp_path = f"{path[:-len(ext)]}.{os.getpid()}.{threading.get_ident()}.tmp{ext}"
+        if kind == 'image':
+            # Save with the dtype of the data, not whatever (possibly integer) dtype the header carries over
+            data = np.asanyarray(value.dataobj)
+            image = nib.Nifti1Image(data, value.affine, value.header)
+            image.set_data_dtype(data.dtype)
+            nib.save(image, tmp_path)
+        elif kind == 'arrays':
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, *value)
+        else:
+            with open(tmp_path, 'w') as f:
+                json.dump(value, f, default=float)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                if '.tmp' in name:
+                    continue  # being written by a running stage
+                full = os.path.join(root, name)
+                try:
+                    stat = os.stat(full)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, full))
+        total = sum(size for _, size, _ in entries)
+        for _, size, full in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(full)
+                total -= size
+                print(f"🧹 Evicted checkpoint: {os.path.basename(full)}")
+            except FileNotFoundError:
+                pass
+
+    def discard(self):
+        """Deletes every checkpoint this chain has run() over so far."""
+        for path in self._paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._paths = []
+
+    def run(self, stages, load_initial, on_stage_done=None):
+        """Runs the stages after the last valid checkpoint and advances self.key past them."""
+        keys = []
+        key = self.key
+        for stage in stages:
+            key = chain_key(key, stage.name, stage.params)
+            keys.append(key)
+            if stage.checkpoint:
+                self._paths.append(self._path(key, stage.kind))
+
+        start, value = 0, None
+        for idx in reversed(range(len(stages))):
+            if not stages[idx].checkpoint:
+                continue
+            value = self._load(keys[idx], stages[idx].kind)
+            if value is not None:
+                start = idx + 1
+                print(f"♻️ Resuming from checkpoint of stage '{stages[idx].name}'.")
+                break
+        if start == 0:
+            value = load_initial()
+
+        for stage, key in zip(stages[start:], keys[start:]):
+            value = stage.compute(value)
+            if stage.checkpoint:
+                self._save(key, stage.kind, value)
+                print(f"💾 Checkpoint saved for stage '{stage.name}'.")
+            if on_stage_done:
+                on_stage_done(stage.name)
+        if keys:
+            self.key = keys[-1]
+        return value
+
+
+def run_stages(stages, load_initial, checkpoints=None, on_stage_done=None):
+    """Runs the stages through the given PipelineCheckpoints, or straight through without one."""
+    if checkpoints is not None:
+        return checkpoints.run(stages, load_initial, on_stage_done)
+    value = load_initial()
+    for stage in stages:
+        value = stage.compute(value)
+        if on_stage_done:
+            on_stage_done(stage.name)
+    return value
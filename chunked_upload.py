@@ -0,0 +1,268 @@
+# ==============================================================================
+# === chunked_upload.py (Streaming, resumable chunked uploads) =================
+# ==============================================================================
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.utils import secure_filename
+
+DEFAULT_UPLOAD_DIR = 'uploads'
+DEFAULT_MAX_UPLOAD_BYTES = int(os.environ.get('NEUROSCOPE_MAX_UPLOAD_MB', 4096)) * 1024 ** 2
+DEFAULT_MAX_CHUNK_BYTES = int(os.environ.get('NEUROSCOPE_MAX_CHUNK_MB', 64)) * 1024 ** 2
+# Chunk size suggested to clients
+DEFAULT_CHUNK_BYTES = 8 * 1024 ** 2
+# Unfinished uploads untouched for this long are deleted
+STALE_UPLOAD_SECONDS = 24 * 3600
+STREAM_BLOCK_BYTES = 1024 ** 2
+
+_PART_FILE = 'data.part'
+_STATE_FILE = 'state.json'
+_LOCK_FILE = 'lock'
+# Finished files go to uploads/<upload_id>/data/<filename>, apart from the manager's own files above,
+# so no client file name (e.g. 'state.json') can overwrite them
+_DATA_DIR = 'data'
+
+
+class UploadError(Exception):
+    """A rejected upload request; status_code is the HTTP status to answer with."""
+
+    def __init__(self, message, status_code=400, **details):
+        super().__init__(message)
+        self.status_code = status_code
+        self.details = details
+
+
+class UploadManager:
+    """
+    Uploads that arrive in chunks, each written straight from the request stream
+    to uploads/<upload_id>/data.part and fed into a running SHA-256 on the way.
+
+    A chunk must start at the offset received so far, so a client that lost its
+    connection asks status() for the offset and continues from there. Bytes of an
+    interrupted chunk that did reach the disk are kept. Per-upload state is a JSON
+    file guarded by an flock, so chunks may land on different app processes; a
+    process whose in-memory hash is not at the current offset rehashes the part
+    file once. complete() renames the data to uploads/<upload_id>/data/<filename>.
+    """
+
+    def __init__(self, upload_dir=DEFAULT_UPLOAD_DIR, max_upload_bytes=DEFAULT_MAX_UPLOAD_BYTES,
+                 max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+        self.upload_dir = os.path.abspath(upload_dir)
+        self.max_upload_bytes = max_upload_bytes
+        self.max_chunk_bytes = max_chunk_bytes
+        self._hashers = {}  # upload_id -> (offset, sha256 object), this process only
+        self._hashers_lock = threading.Lock()
+        os.makedirs(self.upload_dir, exist_ok=True)
+
+    # --- Paths, state and locking -----------------------------------------
+    def _dir(self, upload_id):
+        try:
+            upload_id = str(uuid.UUID(upload_id))
+        except (ValueError, TypeError, AttributeError):
+            raise UploadError("Unknown upload", 404)
+        return os.path.join(self.upload_dir, upload_id)
+
+    @contextmanager
+    def _locked(self, upload_id):
+        upload_dir = self._dir(upload_id)
+        if not os.path.isdir(upload_dir):
+            raise UploadError("Unknown upload", 404)
+        with open(os.path.join(upload_dir, _LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield upload_dir
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _data_path(upload_dir, filename):
+        os.makedirs(os.path.join(upload_dir, _DATA_DIR), exist_ok=True)
+        return os.path.join(upload_dir, _DATA_DIR, filename)
+
+    @staticmethod
+    def _read_state(upload_dir):
+        with open(os.path.join(upload_dir, _STATE_FILE)) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write_state(upload_dir, state):
+        state['updated_at'] = time.time()
+        tmp_path = os.path.join(upload_dir, f"{_STATE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, os.path.join(upload_dir, _STATE_FILE))
+
+    def _hasher(self, upload_id, upload_dir, offset):
+        with self._hashers_lock:
+            memo = self._hashers.get(upload_id)
+        if memo is not None and memo[0] == offset:
+            return memo[1]
+        # Another process wrote the previous chunks (or this one restarted): rehash what is on disk
+        hasher = hashlib.sha256()
+        with open(os.path.join(upload_dir, _PART_FILE), 'rb') as f:
+            remaining = offset
+            while remaining:
+                block = f.read(min(STREAM_BLOCK_BYTES, remaining))
+                if not block:
+                    break
+                hasher.update(block)
+                remaining -= len(block)
+        return hasher
+
+    # --- API --------------------------------------------------------------
+    def create(self, filename, size, metadata=None):
+        """Starts an upload of `size` bytes; returns its state (upload_id, offset, chunk_size)."""
+        filename = secure_filename(filename or '')
+        if not filename:
+            raise UploadError("A file name is required")
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            raise UploadError("The total upload size is required")
+        if size <= 0:
+            raise UploadError("The upload is empty")
+        if size > self.max_upload_bytes:
+            raise UploadError(f"Upload of {size} bytes is over the {self.max_upload_bytes} byte limit", 413)
+
+        self.purge_stale()
+        upload_id = str(uuid.uuid4())
+        upload_dir = self._dir(upload_id)
+        os.makedirs(upload_dir)
+        open(os.path.join(upload_dir, _PART_FILE), 'wb').close()
+        state = {'upload_id': upload_id, 'filename': filename, 'size': size, 'offset': 0,
+                 'complete': False, 'sha256': None, 'metadata': metadata or {}, 'created_at': time.time()}
+        self._write_state(upload_dir, state)
+        return self._public(state)
+
+    def status(self, upload_id):
+        upload_dir = self._dir(upload_id)
+        try:
+            return self._public(self._read_state(upload_dir))
+        except FileNotFoundError:
+            raise UploadError("Unknown upload", 404)
+
+    def write_chunk(self, upload_id, offset, stream, length=None):
+        """
+        Streams one chunk from `stream` to the upload at `offset`. length (the
+        request's Content-Length) lets oversized chunks be refused before reading.
+        """
+        with self._locked(upload_id) as upload_dir:
+            state = self._read_state(upload_dir)
+            if state['complete']:
+                raise UploadError("Upload is already complete", 409, offset=state['offset'])
+            if offset != state['offset']:
+                raise UploadError(f"Expected a chunk at offset {state['offset']}, got {offset}", 409,
+                                  offset=state['offset'])
+            limit = min(self.max_chunk_bytes, state['size'] - state['offset'])
+            if length is not None and length > limit:
+                raise UploadError(f"Chunk of {length} bytes is over the {limit} byte limit", 413,
+                                  offset=state['offset'])
+
+            hasher = self._hasher(upload_id, upload_dir, offset).copy()
+            written = 0
+            overflow = False
+            with open(os.path.join(upload_dir, _PART_FILE), 'r+b') as f:
+                f.seek(offset)
+                f.truncate()
+                try:
+                    while True:
+                        block = stream.read(min(STREAM_BLOCK_BYTES, limit - written + 1))
+                        if not block:
+                            break
+                        if written + len(block) > limit:
+                            overflow = True
+                            break
+                        f.write(block)
+                        hasher.update(block)
+                        written += len(block)
+                except (ClientDisconnected, OSError, ValueError) as e:
+                    # Connection dropped mid-chunk: keep what arrived, the client resumes from the new offset
+                    print(f"⚠️ Upload {upload_id}: chunk interrupted after {written} bytes ({e})")
+                if overflow:
+                    f.truncate(offset)
+            if overflow:
+                raise UploadError(f"Chunk is over the {limit} byte limit", 413, offset=offset)
+
+            state['offset'] = offset + written
+            with self._hashers_lock:
+                self._hashers[upload_id] = (state['offset'], hasher)
+            self._write_state(upload_dir, state)
+            return self._public(state)
+
+    def complete(self, upload_id, expected_sha256=None):
+        """Finishes an upload; returns (path, sha256, state). A complete upload is returned as is."""
+        with self._locked(upload_id) as upload_dir:
+            state = self._read_state(upload_dir)
+            final_path = self._data_path(upload_dir, state['filename'])
+            if not state['complete']:
+                if state['offset'] != state['size']:
+                    raise UploadError(f"Upload is incomplete: {state['offset']} of {state['size']} bytes received",
+                                      409, offset=state['offset'])
+                sha256 = self._hasher(upload_id, upload_dir, state['offset']).hexdigest()
+                if expected_sha256 and expected_sha256.lower() != sha256:
+                    raise UploadError("SHA-256 mismatch, the upload is corrupt", 422, sha256=sha256)
+                os.replace(os.path.join(upload_dir, _PART_FILE), final_path)
+                state.update({'complete': True, 'sha256': sha256})
+                self._write_state(upload_dir, state)
+                with self._hashers_lock:
+                    self._hashers.pop(upload_id, None)
+            return final_path, state['sha256'], self._public(state)
+
+    def save_stream(self, filename, stream, metadata=None):
+        """Single-request upload (multipart /upload): streamed to its own directory and hashed the same way."""
+        filename = secure_filename(filename or '')
+        if not filename:
+            raise UploadError("A file name is required")
+        upload_id = str(uuid.uuid4())
+        upload_dir = self._dir(upload_id)
+        os.makedirs(upload_dir)
+        final_path = self._data_path(upload_dir, filename)
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with open(final_path, 'wb') as f:
+                for block in iter(lambda: stream.read(STREAM_BLOCK_BYTES), b''):
+                    size += len(block)
+                    if size > self.max_upload_bytes:
+                        raise UploadError(f"Upload is over the {self.max_upload_bytes} byte limit", 413)
+                    f.write(block)
+                    hasher.update(block)
+        except UploadError:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            raise
+        state = {'upload_id': upload_id, 'filename': filename, 'size': size, 'offset': size, 'complete': True,
+                 'sha256': hasher.hexdigest(), 'metadata': metadata or {}, 'created_at': time.time()}
+        self._write_state(upload_dir, state)
+        return final_path, state['sha256'], self._public(state)
+
+    def delete(self, upload_id):
+        shutil.rmtree(self._dir(upload_id), ignore_errors=True)
+        with self._hashers_lock:
+            self._hashers.pop(upload_id, None)
+
+    def purge_stale(self, max_age_seconds=STALE_UPLOAD_SECONDS):
+        """Deletes unfinished uploads nobody has written to for max_age_seconds."""
+        cutoff = time.time() - max_age_seconds
+        for name in os.listdir(self.upload_dir):
+            state_path = os.path.join(self.upload_dir, name, _STATE_FILE)
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not state.get('complete') and state.get('updated_at', 0) < cutoff:
+                print(f"🧹 Removing stale upload {name}")
+                shutil.rmtree(os.path.join(self.upload_dir, name), ignore_errors=True)
+
+    def _public(self, state):
+        return {'upload_id': state['upload_id'], 'filename': state['filename'], 'size': state['size'],
+                'offset': state['offset'], 'complete': state['complete'], 'sha256': state['sha256'],
+                'chunk_size': min(DEFAULT_CHUNK_BYTES, self.max_chunk_bytes), 'metadata': state['metadata']}
@@ -0,0 +1,287 @@
+# ==============================================================================
+# === cohort_batch.py (Batch runner: BIDS/fMRIPrep cohort -> one feature table) =
+# ==============================================================================
+"""
+Runs the NiLearn + entropy pipeline for every subject of an fMRIPrep derivatives
+tree and appends one row per subject/run to a single CSV table.
+
+    python cohort_batch.py /data/derivatives/fmriprep cohort_features.csv
+    python cohort_batch.py /data/derivatives/fmriprep cohort_features.csv --participant 01 02 --float32
+    python cohort_batch.py /data/derivatives/fmriprep cohort_features.csv --dynamic-window 50 --dynamic-step 5
+
+Rows already in the table are skipped, so an interrupted run is continued by
+starting it again. Failed subjects are reported and left out of the table
+(the next run retries them). With --dynamic-window every subject also gets
+sliding-window SampEn/FuzzyEn (entropy_calculator.dynamic_entropy) in
+<table>_dynamic/<subject>/dynamic_entropy.npz.
+"""
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import nibabel as nib
+import numpy as np
+
+import entropy_calculator
+import feature_store
+import fmri_processing
+import job_scheduler
+import resources
+import result_cache
+
+BOLD_PATTERN = '*_space-MNI152NLin2009cAsym*_desc-preproc_bold.nii.gz'
+CONFOUNDS_SUFFIX = '_desc-confounds_timeseries.tsv'
+DEFAULT_TR = 2.0
+# Headroom over the estimated NiLearn peak (entropy stage, interpreter, libraries)
+SUBJECT_OVERHEAD_MB = 512
+
+# feature_definition: 'standard', the features the models read (older tables may hold other definitions)
+ID_COLUMNS = ['subject', 'bold_path', 'feature_definition']
+
+
+# === SUBJECT DISCOVERY ===
+def _run_label(bold_path):
+    """BIDS entities before the space- entity, e.g. 'sub-01_ses-1_task-rest_run-1'."""
+    return re.split(r'_space-', os.path.basename(bold_path))[0]
+
+
+def _confounds_path(bold_path):
+    # fMRIPrep names the confounds after the run entities, without space-/desc- (older releases: desc-confounds_regressors)
+    prefix = os.path.join(os.path.dirname(bold_path), _run_label(bold_path))
+    for suffix in (CONFOUNDS_SUFFIX, '_desc-confounds_regressors.tsv'):
+        if os.path.exists(prefix + suffix):
+            return prefix + suffix
+    return None
+
+
+def discover_subjects(derivatives_dir, participants=None):
+    """
+    Every preprocessed BOLD run (MNI152NLin2009cAsym) under sub-*/[ses-*/]func/
+    with its confounds file, as a sorted list of dicts (subject, bold_path,
+    confounds_path). participants limits it to these labels (with or without 'sub-').
+    """
+    wanted = {p if p.startswith('sub-') else f"sub-{p}" for p in participants} if participants else None
+    subjects = []
+    for bold_path in sorted(glob.glob(os.path.join(derivatives_dir, 'sub-*', '**', 'func', BOLD_PATTERN),
+                                      recursive=True)):
+        label = _run_label(bold_path)
+        if wanted is not None and label.split('_')[0] not in wanted:
+            continue
+        confounds_path = _confounds_path(bold_path)
+        if confounds_path is None:
+            print(f"⚠️ {label}: no confounds file next to {bold_path}, skipping.")
+            continue
+        subjects.append({'subject': label, 'bold_path': os.path.abspath(bold_path),
+                         'confounds_path': os.path.abspath(confounds_path)})
+    return subjects
+
+
+# === POOL SIZING ===
+def estimate_subject_mb(subjects, dtype=np.float64, use_brain_mask=False):
+    """Peak memory of one worker for the largest run in the cohort, read from the NIfTI headers only."""
+    template_shape = resources.get_mni152_template_3mm().shape
+    peak_mb = max(fmri_processing.estimate_nilearn_peak_mb(nib.load(s['bold_path']).shape, template_shape,
+                                                           dtype, use_brain_mask)
+                  for s in subjects)
+    return peak_mb + SUBJECT_OVERHEAD_MB
+
+
+def pool_size(n_subjects, subject_mb, max_workers=None):
+    """Workers = min(cores, available memory / per-subject peak, subjects), at least 1."""
+    workers = os.cpu_count() or 1
+    free_mb = job_scheduler.available_memory_mb()
+    if free_mb is not None:
+        workers = min(workers, int(free_mb // subject_mb))
+    if max_workers:
+        workers = min(workers, max_workers)
+    return max(1, min(workers, n_subjects))
+
+
+# === RESULT TABLE ===
+def read_done_subjects(table_path, definition=fmri_processing.STANDARD_FEATURE_DEFINITION):
+    """Subjects already in the table (empty for a new table); one table never mixes feature definitions."""
+    if not os.path.exists(table_path) or os.path.getsize(table_path) == 0:
+        return set()
+    with open(table_path, newline='') as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames[:len(ID_COLUMNS)] != ID_COLUMNS:
+            raise ValueError(f"{table_path} does not start with the columns {ID_COLUMNS}; "
+                             f"write to a new table.")
+        rows = list(reader)
+    other = {row['feature_definition'] for row in rows} - {definition}
+    if other:
+        raise ValueError(f"{table_path} holds {sorted(other)} features, not '{definition}'; write to a new table.")
+    return {row['subject'] for row in rows}
+
+
+class FeatureTable:
+    """The consolidated CSV: one row per subject, appended and flushed as each subject finishes."""
+
+    needs_content_hash = False
+
+    def __init__(self, path, definition=fmri_processing.STANDARD_FEATURE_DEFINITION):
+        self.path = path
+        self.definition = definition
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'a', newline='')
+        self._writer = csv.writer(self._file)
+        if new:
+            self._writer.writerow(ID_COLUMNS + entropy_calculator.feature_column_names())
+            self._file.flush()
+
+    def done_subjects(self):
+        return read_done_subjects(self.path, self.definition)
+
+    def append(self, subject, features, content_hash=None):
+        self._writer.writerow([subject['subject'], subject['bold_path'], self.definition]
+                              + [repr(float(v)) for v in features])
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class FeatureStoreTable:
+    """Same interface as FeatureTable, backed by a feature_store.FeatureStore directory."""
+
+    # The store indexes each row by the BOLD file's content hash, computed by the worker
+    needs_content_hash = True
+
+    def __init__(self, path):
+        self.store = feature_store.FeatureStore(path)
+
+    def done_subjects(self):
+        return {row['subject'] for row in self.store.index()}
+
+    def append(self, subject, features, content_hash=None):
+        self.store.append(features, subject=subject['subject'], content_hash=content_hash or '')
+
+    def close(self):
+        pass
+
+
+# === WORKER ===
+def process_subject(subject, tr=None, use_brain_mask=False, dtype=np.float64, memory_budget_mb=None,
+                    dynamic_window=None, dynamic_step=1, dynamic_dir=None):
+    """
+    NiLearn post-processing + entropy features of one run; returns the 1056-feature vector.
+    memory_budget_mb is enforced in both stages (a MemoryError fails only this subject).
+    With dynamic_window (samples) the per-window entropies of the same ROI series are
+    written to dynamic_dir/<subject>/dynamic_entropy.npz.
+    """
+    if tr is None:
+        # Repetition time from the BOLD header, the app's default when the header has none
+        tr = float(nib.load(subject['bold_path']).header.get_zooms()[3]) or DEFAULT_TR
+    final_img = fmri_processing.run_nilearn_processing(
+        os.path.dirname(subject['bold_path']), f"cohort_{subject['subject']}", tr=tr,
+        use_brain_mask=use_brain_mask, dtype=dtype, memory_budget_mb=memory_budget_mb, save_output=None,
+        return_img=True, input_files=(subject['bold_path'], subject['confounds_path']))
+    features, timeseries_std, timeseries_raw = entropy_calculator.calculate_entropy_features(
+        final_img, t_r=tr, dtype=dtype, memory_budget_mb=memory_budget_mb, return_timeseries=True)
+    if dynamic_window:
+        dynamic = entropy_calculator.dynamic_entropy(timeseries_std, timeseries_raw, dynamic_window, step=dynamic_step)
+        entropy_calculator.save_dynamic_entropy(dynamic.astype(dtype), os.path.join(dynamic_dir, subject['subject']),
+                                                dynamic_window, dynamic_step, tr)
+    return features
+
+
+def _pool_task(task):
+    subject, options, with_hash = task
+    try:
+        features = process_subject(subject, **options)
+        # Hashed here, in parallel, rather than by the parent for every finished subject
+        content_hash = result_cache.file_sha256(subject['bold_path']) if with_hash else None
+        return subject, features, content_hash, None
+    except Exception as e:
+        return subject, None, None, str(e)
+
+
+def dynamic_output_dir(table_path):
+    """Folder of the per-subject dynamic entropies: next to the table, '<table>_dynamic'."""
+    return os.path.splitext(os.path.abspath(table_path).rstrip(os.sep))[0] + '_dynamic'
+
+
+def run_cohort(derivatives_dir, table_path, participants=None, workers=None, tr=None, use_brain_mask=False,
+               dtype=np.float64, use_feature_store=False, memory_budget_mb=None, dynamic_window=None,
+               dynamic_step=1):
+    """
+    Processes every subject not yet in table_path; returns (done, failed) counts.
+    With use_feature_store=True table_path is a feature_store directory instead of a CSV.
+    dynamic_window/dynamic_step (samples) also write each subject's sliding-window
+    entropies under dynamic_output_dir(table_path).
+    """
+    subjects = discover_subjects(derivatives_dir, participants)
+    table = FeatureStoreTable(table_path) if use_feature_store else FeatureTable(table_path)
+    try:
+        done = table.done_subjects()
+        todo = [s for s in subjects if s['subject'] not in done]
+        print(f"🧠 {len(subjects)} run(s) found, {len(subjects) - len(todo)} already in {table_path}, "
+              f"{len(todo)} to process.")
+        if not todo:
+            return 0, 0
+
+        subject_mb = estimate_subject_mb(todo, dtype, use_brain_mask)
+        n_workers = pool_size(len(todo), subject_mb, workers)
+        print(f"🏃 {n_workers} worker process(es), ~{subject_mb:.0f} MB per subject.")
+
+        n_done = n_failed = 0
+        started = time.time()
+        options = {'tr': tr, 'use_brain_mask': use_brain_mask, 'dtype': dtype, 'memory_budget_mb': memory_budget_mb,
+                   'dynamic_window': dynamic_window, 'dynamic_step': dynamic_step,
+                   'dynamic_dir': dynamic_output_dir(table_path)}
+        tasks = [(s, options, table.needs_content_hash) for s in todo]
+        # fork: the workers inherit the already imported NiLearn modules (this CLI is single-threaded)
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+        # One subject per worker process, so each subject's memory goes back to the OS when it ends
+        with context.Pool(n_workers, maxtasksperchild=1) as pool:
+            for subject, features, content_hash, error in pool.imap_unordered(_pool_task, tasks):
+                if error is not None:
+                    n_failed += 1
+                    print(f"🚨 {subject['subject']} failed: {error}")
+                    continue
+                table.append(subject, features, content_hash)
+                n_done += 1
+                elapsed = time.time() - started
+                print(f"✅ {subject['subject']} ({n_done + n_failed}/{len(todo)}, {elapsed:.0f} s elapsed)")
+    finally:
+        table.close()
+    print(f"🏁 {n_done} subject(s) added to {table_path}, {n_failed} failed.")
+    return n_done, n_failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Entropy features for a whole fMRIPrep cohort, in one table.")
+    parser.add_argument('derivatives_dir', help="fMRIPrep derivatives folder (contains sub-*/)")
+    parser.add_argument('table', help="CSV feature table (or feature store directory); rows already in it are skipped")
+    parser.add_argument('--participant', nargs='+', help="only these participant labels")
+    parser.add_argument('--workers', type=int, help="upper bound on worker processes (default: cores / memory)")
+    parser.add_argument('--tr', type=float, help="repetition time in s (default: from each BOLD header)")
+    parser.add_argument('--brain-mask', action='store_true',
+                        help="scrub and regress only the in-brain voxels (same features, faster)")
+    parser.add_argument('--float32', action='store_true', help="single-precision intermediates")
+    parser.add_argument('--memory-budget-mb', type=float,
+                        help="per-subject memory budget; a subject over it fails instead of exhausting the node")
+    parser.add_argument('--feature-store', action='store_true',
+                        help="write to a binary feature store directory instead of a CSV")
+    parser.add_argument('--dynamic-window', type=int,
+                        help="also write sliding-window SampEn/FuzzyEn per subject, windows of this many TRs")
+    parser.add_argument('--dynamic-step', type=int, default=1, help="TRs between dynamic window starts (default: 1)")
+    args = parser.parse_args(argv)
+
+    _, n_failed = run_cohort(args.derivatives_dir, args.table, participants=args.participant, workers=args.workers,
+                             tr=args.tr, use_brain_mask=args.brain_mask,
+                             dtype=np.float32 if args.float32 else np.float64, use_feature_store=args.feature_store,
+                             memory_budget_mb=args.memory_budget_mb, dynamic_window=args.dynamic_window,
+                             dynamic_step=args.dynamic_step)
+    return 1 if n_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
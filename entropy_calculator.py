@@ -1,24 +1,44 @@
 import numpy as np
 import pandas as pd
-from nilearn import datasets, input_data
-import antropy as ant
+from nilearn import image, signal
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from numpy.lib.stride_tricks import sliding_window_view
 
-# === Atlas ve sabitleri modül yüklendiğinde bir kez yükle (Performans için) ===
-try:
-    print("🧠 Power2011 Atlas yükleniyor...")
-    POWER_ATLAS = datasets.fetch_coords_power_2011()
-    ATLAS_COORDS = list(zip(POWER_ATLAS.rois['x'], POWER_ATLAS.rois['y'], POWER_ATLAS.rois['z']))
-    N_ROIS = len(ATLAS_COORDS)
-    print("✅ Atlas yüklendi.")
-except Exception as e:
-    print(f"❌ Atlas yüklenirken hata oluştu: {e}")
-    ATLAS_COORDS = None
-    N_ROIS = 0
+import sphere_operator
+from checkpoints import Stage
+from memory_budget import MemoryBudget
+
+# Power2011 atlası: 264 ROI
+N_ROIS = 264
+
+# Upper bound for the (rows x templates x ROIs) intermediates of one block in the batched kernels
+DEFAULT_MAX_BLOCK_BYTES = 64 * 1024 ** 2
+# With a memory budget the blocks get at most this share of it (the rest: series, image, interpreter)
+BLOCK_SHARE_OF_BUDGET = 1 / 16
+# ROIs handed to the engine per call; serial and parallel runs use the same chunks, so results are bit-identical
+DEFAULT_ROI_CHUNK_SIZE = 16
+
+# Order of the entropy types in the feature vector (each block has one value per ROI)
+ENTROPY_TYPES = ('SaEn', 'DiffEn', 'FuEn', 'RaEn')
+# The types computed from template pairs by template_entropy_engine
+PAIR_ENTROPY_TYPES = ('SaEn', 'FuEn', 'RaEn')
+
+# Power2011 sphere radius in mm
+ATLAS_RADIUS = 5
+
+# Band-pass applied to the ROI signals after sphere extraction
+ROI_LOW_PASS = 0.08
+ROI_HIGH_PASS = 0.009
 
 
 # === FinalEntropy.py dosyasından gelen özel Entropi Fonksiyonları ===
 def sample_entropy_custom(ts):
+    # Referans implementasyon; antropy (numba) yalnızca burada, ilk çağrıda yüklenir
+    import antropy as ant
+
     ts = np.ascontiguousarray(ts, dtype=np.float64)
     r = 0.2 * ts.std()
     return ant.sample_entropy(ts, 2, r)
@@ -54,100 +74,887 @@ def fuzzy_entropy(x, m=2, r_ratio=0.2, n=2):
     return -np.log(phi_m1 / phi_m)
 
 
+# === Batched (T x ROI) entropy kernels ===
+def _as_timeseries_matrix(timeseries, dtype=np.float64):
+    X = np.asarray(timeseries, dtype=dtype)
+    if X.ndim == 1:
+        X = X[:, np.newaxis]
+    if X.ndim != 2:
+        raise ValueError(f"Expected a (T x ROI) matrix, got an array of shape {X.shape}.")
+    return X
+
+
+def _column_tolerances(X, r_ratio):
+    # Per-column std, so every ROI gets exactly the r the 1D functions would compute
+    return np.array([r_ratio * np.std(np.ascontiguousarray(X[:, i])) for i in range(X.shape[1])])
+
+
+def _iter_template_blocks(X, m, max_block_bytes=DEFAULT_MAX_BLOCK_BYTES, with_min=False):
+    """
+    Walks the upper triangle (i < j) of the template-pair matrix of every column of X
+    in row blocks whose intermediates stay under max_block_bytes.
+
+    Yields (upper, dist_m, min_m, dist_last) per block:
+        upper     (b, c) bool mask of the pairs with j > i inside the block,
+        dist_m    (b, c, ROI) Chebyshev distance (max |x_i - x_j|) of the length-m templates,
+        min_m     (b, c, ROI) min |x_i - x_j| of the length-m templates, or None unless with_min,
+        dist_last (b, c - 1, ROI) |x[i + m] - x[j + m]|, the extra coordinate of the
+                  length-(m + 1) templates (only defined for j < N - m).
+    """
+    n_samples, n_rois = X.shape
+    n_templates = n_samples - m + 1
+    if n_templates < 2:
+        return
+    emb = sliding_window_view(X, m, axis=0)  # (templates, ROI, m), no copy
+    n_buffers = 5 if with_min else 4
+    rows_per_block = max(1, max_block_bytes // (n_buffers * X.itemsize * n_templates * n_rois))
+
+    for i0 in range(0, n_templates - 1, rows_per_block):
+        i1 = min(i0 + rows_per_block, n_templates - 1)
+        j0 = i0 + 1
+        upper = np.arange(n_templates - j0)[np.newaxis, :] >= np.arange(i1 - i0)[:, np.newaxis]
+
+        dist_m = np.abs(emb[i0:i1, np.newaxis, :, 0] - emb[np.newaxis, j0:, :, 0])
+        min_m = dist_m.copy() if with_min else None
+        for k in range(1, m):
+            diff = np.abs(emb[i0:i1, np.newaxis, :, k] - emb[np.newaxis, j0:, :, k])
+            np.maximum(dist_m, diff, out=dist_m)
+            if with_min:
+                np.minimum(min_m, diff, out=min_m)
+        dist_last = np.abs(X[i0 + m:i1 + m, np.newaxis, :] - X[np.newaxis, j0 + m:, :])
+        yield upper, dist_m, min_m, dist_last
+
+
+def _fuzzy_pair_sums(upper, dist_m, dist_m1, r_safe, n):
+    # sum over the i < j pairs of exp(-d^n / r), for the length-m and length-(m + 1) templates;
+    # always accumulated in float64, also when the distances are float32
+    sum_m = np.einsum('ij,ijk->k', upper, np.exp(-np.power(dist_m, n) / r_safe), dtype=np.float64)
+    sum_m1 = np.einsum('ij,ijk->k', upper[:, :-1], np.exp(-np.power(dist_m1, n) / r_safe), dtype=np.float64)
+    return sum_m, sum_m1
+
+
+def _fuzzy_from_sums(sum_m, sum_m1, n_samples, m, r):
+    # The similarity matrix is symmetric with ones on the diagonal:
+    # phi = (N + 2 * sum_{i<j} exp(-d^n / r)) / N^2
+    def _phi(pair_sum, n_templates):
+        if n_templates <= 1:
+            return np.zeros(len(r))
+        return (n_templates + 2.0 * pair_sum) / (n_templates * n_templates)
+
+    phi_m = _phi(sum_m, n_samples - m + 1)
+    phi_m1 = _phi(sum_m1, n_samples - m)
+    values = np.zeros(len(r))
+    ok = (r > 0) & (phi_m != 0) & (phi_m1 != 0)
+    values[ok] = -np.log(phi_m1[ok] / phi_m[ok])
+    return values
+
+
+def _range_pair_counts(upper, dist_m, dist_m1, min_m, min_m1, r):
+    B = np.count_nonzero(((dist_m - min_m) < r) & upper[:, :, np.newaxis], axis=(0, 1))
+    A = np.count_nonzero(((dist_m1 - min_m1) < r) & upper[:, :-1, np.newaxis], axis=(0, 1))
+    return B, A
+
+
+def _range_from_counts(B, A, r):
+    values = np.zeros(len(B))
+    ok = (r > 0) & (B > 0) & (A > 0)
+    values[ok] = -np.log(A[ok] / B[ok])
+    return values
+
+
+def _sampen_pair_counts(upper, dist_m, dist_m1, r):
+    # antropy compares the first N - m templates for both m and m + 1, so the
+    # last length-m template (the last column of the block) is left out
+    B = np.count_nonzero((dist_m[:, :-1] < r) & upper[:, :-1, np.newaxis], axis=(0, 1))
+    A = np.count_nonzero((dist_m1 < r) & upper[:, :-1, np.newaxis], axis=(0, 1))
+    return B, A
+
+
+def _sampen_from_counts(B, A):
+    # Same conventions as ant.sample_entropy: nan without any m match, inf without any m + 1 match
+    values = np.full(len(B), np.nan)
+    values[(B > 0) & (A == 0)] = np.inf
+    ok = (B > 0) & (A > 0)
+    values[ok] = -np.log(A[ok] / B[ok])
+    return values
+
+
+def _extend_to_m1(dist_m, dist_last, reduce):
+    # Distances of the length-(m + 1) templates from the length-m ones plus the extra coordinate
+    return reduce(dist_m[:, :-1], dist_last)
+
+
+def fuzzy_entropy_batch(timeseries, m=2, r_ratio=0.2, n=2, max_block_bytes=DEFAULT_MAX_BLOCK_BYTES,
+                        dtype=np.float64):
+    """
+    Batched version of fuzzy_entropy for a whole (T x ROI) matrix.
+    dtype=np.float32 halves the block memory at float32 precision for the distances.
+
+    Returns:
+        np.ndarray: One fuzzy entropy value per ROI, equal to fuzzy_entropy(column).
+    """
+    X = _as_timeseries_matrix(timeseries, dtype)
+    n_samples, n_rois = X.shape
+    r = _column_tolerances(X, r_ratio)
+    r_safe = np.where(r > 0, r, 1.0)
+
+    sum_m = np.zeros(n_rois)
+    sum_m1 = np.zeros(n_rois)
+    for upper, dist_m, _, dist_last in _iter_template_blocks(X, m, max_block_bytes):
+        dist_m1 = _extend_to_m1(dist_m, dist_last, np.maximum)
+        block_m, block_m1 = _fuzzy_pair_sums(upper, dist_m, dist_m1, r_safe, n)
+        sum_m += block_m
+        sum_m1 += block_m1
+    return _fuzzy_from_sums(sum_m, sum_m1, n_samples, m, r)
+
+
+def range_entropy_counts(timeseries, m=2, r_ratio=0.2, max_block_bytes=DEFAULT_MAX_BLOCK_BYTES, dtype=np.float64):
+    """
+    Counts, for every ROI column, the template pairs (i < j) whose range distance
+    max|x_i - x_j| - min|x_i - x_j| is below r = r_ratio * std.
+
+    The m + 1 distances are derived from the m ones by folding in the extra
+    coordinate, so B and A come out of the same block-wise max/min reductions.
+
+    Returns:
+        tuple: (B, A, r) arrays with one entry per ROI; B counts the length-m pairs,
+        A the length-(m + 1) pairs.
+    """
+    X = _as_timeseries_matrix(timeseries, dtype)
+    n_rois = X.shape[1]
+    r = _column_tolerances(X, r_ratio)
+
+    B = np.zeros(n_rois, dtype=np.int64)
+    A = np.zeros(n_rois, dtype=np.int64)
+    for upper, dist_m, min_m, dist_last in _iter_template_blocks(X, m, max_block_bytes, with_min=True):
+        block_B, block_A = _range_pair_counts(
+            upper, dist_m, _extend_to_m1(dist_m, dist_last, np.maximum),
+            min_m, _extend_to_m1(min_m, dist_last, np.minimum), r
+        )
+        B += block_B
+        A += block_A
+    return B, A, r
+
+
+def range_entropy_batch(timeseries, m=2, r_ratio=0.2, max_block_bytes=DEFAULT_MAX_BLOCK_BYTES):
+    """Range entropy -log(A / B) for every column of a (T x ROI) matrix."""
+    B, A, r = range_entropy_counts(timeseries, m, r_ratio, max_block_bytes)
+    return _range_from_counts(B, A, r)
+
+
+def template_entropy_engine(timeseries_std, timeseries_raw, m=2, r_ratio=0.2, n=2,
+                            max_block_bytes=DEFAULT_MAX_BLOCK_BYTES, dtype=np.float64, kinds=PAIR_ENTROPY_TYPES):
+    """
+    Computes SampEn (on the standardized series), FuzzyEn and RangeEn (on the raw
+    series) for every ROI in a single pass over the template-pair blocks.
+
+    Both matrices are walked side by side as one (T x 2*ROI) matrix, so each pair
+    block is built once and feeds the sample-entropy match counts, the fuzzy
+    similarity sums and the range-distance counts together.
+
+    dtype=np.float32 runs the distance blocks in single precision (twice the rows
+    per block for the same memory cap); fuzzy sums are still accumulated in float64.
+
+    kinds limits the work to some of 'SaEn', 'FuEn', 'RaEn': without SaEn the
+    standardized series is not walked at all, without FuEn/RaEn the raw one, and
+    the min-distance blocks are only built for RaEn.
+
+    Returns:
+        dict: {'SaEn': ..., 'FuEn': ..., 'RaEn': ...} (the requested kinds), one array
+        of ROI values each, matching sample_entropy_custom, fuzzy_entropy and compute_range_entropy.
+    """
+    unknown = set(kinds) - set(PAIR_ENTROPY_TYPES)
+    if unknown:
+        raise ValueError(f"Unknown pair entropy type(s) {sorted(unknown)}, expected some of {PAIR_ENTROPY_TYPES}.")
+    X_std = _as_timeseries_matrix(timeseries_std, dtype)
+    X_raw = _as_timeseries_matrix(timeseries_raw, dtype)
+    if X_std.shape != X_raw.shape:
+        raise ValueError(f"Standardized and raw series differ in shape: {X_std.shape} vs {X_raw.shape}.")
+    n_samples, n_rois = X_raw.shape
+    use_std = 'SaEn' in kinds
+    use_raw = 'FuEn' in kinds or 'RaEn' in kinds
+    with_min = 'RaEn' in kinds
+    std_cols = slice(0, n_rois if use_std else 0)
+    raw_cols = slice(std_cols.stop, std_cols.stop + (n_rois if use_raw else 0))
+
+    r_std = _column_tolerances(X_std, r_ratio) if use_std else None
+    r_raw = _column_tolerances(X_raw, r_ratio) if use_raw else None
+    r_raw_safe = np.where(r_raw > 0, r_raw, 1.0) if use_raw else None
+
+    saen_B = np.zeros(n_rois, dtype=np.int64)
+    saen_A = np.zeros(n_rois, dtype=np.int64)
+    range_B = np.zeros(n_rois, dtype=np.int64)
+    range_A = np.zeros(n_rois, dtype=np.int64)
+    fuzzy_m = np.zeros(n_rois)
+    fuzzy_m1 = np.zeros(n_rois)
+
+    X = np.concatenate([X_std] * use_std + [X_raw] * use_raw, axis=1)
+    for upper, dist_m, min_m, dist_last in _iter_template_blocks(X, m, max_block_bytes, with_min=with_min):
+        dist_m1 = _extend_to_m1(dist_m, dist_last, np.maximum)
+
+        if use_std:
+            block_B, block_A = _sampen_pair_counts(upper, dist_m[..., std_cols], dist_m1[..., std_cols], r_std)
+            saen_B += block_B
+            saen_A += block_A
+
+        raw_m, raw_m1 = dist_m[..., raw_cols], dist_m1[..., raw_cols]
+        if 'FuEn' in kinds:
+            block_m, block_m1 = _fuzzy_pair_sums(upper, raw_m, raw_m1, r_raw_safe, n)
+            fuzzy_m += block_m
+            fuzzy_m1 += block_m1
+
+        if with_min:
+            min_raw = min_m[..., raw_cols]
+            block_B, block_A = _range_pair_counts(
+                upper, raw_m, raw_m1, min_raw, _extend_to_m1(min_raw, dist_last[..., raw_cols], np.minimum), r_raw
+            )
+            range_B += block_B
+            range_A += block_A
+
+    results = {}
+    if use_std:
+        results['SaEn'] = _sampen_from_counts(saen_B, saen_A)
+    if 'FuEn' in kinds:
+        results['FuEn'] = _fuzzy_from_sums(fuzzy_m, fuzzy_m1, n_samples, m, r_raw)
+    if with_min:
+        results['RaEn'] = _range_from_counts(range_B, range_A, r_raw)
+    return results
+
+
 def compute_range_entropy(ts, m=2, r_ratio=0.2):
     """Antropy'de bulunmayan özel bir range entropy implementasyonu."""
+    return float(range_entropy_batch(ts, m, r_ratio)[0])
 
-    def range_distance(x, y):
-        return np.max(np.abs(x - y)) - np.min(np.abs(x - y))
 
-    def _count_similar(template_vectors, r):
-        count = 0
-        N = len(template_vectors)
-        for i in range(N):
-            for j in range(i + 1, N):
-                if range_distance(template_vectors[i], template_vectors[j]) < r:
-                    count += 1
-        return count
+# === Parallel ROI execution (shared-memory process pool) ===
+_SHARED_TIMESERIES = None
 
-    ts = np.ascontiguousarray(ts, dtype=np.float64)
-    N = len(ts)
-    r = r_ratio * np.std(ts)
-    if r == 0: return 0.0
 
-    Xm = np.array([ts[i:i + m] for i in range(N - m + 1)])
-    Xm1 = np.array([ts[i:i + m + 1] for i in range(N - m)])
-    B = _count_similar(Xm, r)
-    A = _count_similar(Xm1, r)
+def _attach_shared_timeseries(shm_name, shape, dtype):
+    # Pool initializer: map the (2, T, ROI) std/raw block once per worker instead of pickling it per task
+    global _SHARED_TIMESERIES
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _SHARED_TIMESERIES = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
 
-    if B == 0 or A == 0:
-        return 0.0
-    return -np.log(A / B)
 
+def _engine_on_shared_chunk(roi_slice, engine_kwargs):
+    _, stacked = _SHARED_TIMESERIES
+    return template_entropy_engine(stacked[0][:, roi_slice], stacked[1][:, roi_slice], dtype=stacked.dtype,
+                                   **engine_kwargs)
 
-# === ANA FONKSİYON ===
-def calculate_entropy_features(nilearn_processed_path, t_r=2.0):
+
+def _roi_chunks(n_rois, roi_chunk_size):
+    roi_chunk_size = max(1, int(roi_chunk_size or n_rois))
+    return [slice(start, min(start + roi_chunk_size, n_rois)) for start in range(0, n_rois, roi_chunk_size)]
+
+
+def compute_pair_entropies(timeseries_std, timeseries_raw, n_jobs=1, roi_chunk_size=DEFAULT_ROI_CHUNK_SIZE,
+                           dtype=np.float64, progress=None, kinds=PAIR_ENTROPY_TYPES, **engine_kwargs):
     """
-    Nilearn ile işlenmiş tek bir NIfTI dosyasını alır,
-    ROI zaman serilerini çıkarır ve tüm entropi özelliklerini hesaplar.
+    Runs template_entropy_engine over ROI chunks, serially or across a process pool.
+
+    With n_jobs > 1 the standardized and raw series are copied once into shared
+    memory and each worker reads its ROI columns from there. Chunks are returned
+    in ROI order and are identical for every n_jobs, so the output does not
+    depend on the worker count.
 
     Args:
-        nilearn_processed_path (str): Nilearn pipeline'ından gelen son .nii.gz dosyasının yolu.
-        t_r (float): Repetition time.
+        n_jobs (int): Number of worker processes; 1 (default) runs in-process, -1 uses all cores.
+        roi_chunk_size (int): ROIs per engine call.
+        progress (callable): Called as progress(done_chunks, total_chunks) after every chunk.
+        kinds (tuple): The pair entropies to compute (see template_entropy_engine).
 
     Returns:
-        np.ndarray: Makine öğrenmesi modeli için girdi olabilecek 1D bir özellik vektörü.
+        dict: {'SaEn': ..., 'FuEn': ..., 'RaEn': ...} as returned by template_entropy_engine.
+    """
+    engine_kwargs['kinds'] = tuple(kinds)
+    X_std = _as_timeseries_matrix(timeseries_std, dtype)
+    X_raw = _as_timeseries_matrix(timeseries_raw, dtype)
+    if X_std.shape != X_raw.shape:
+        raise ValueError(f"Standardized and raw series differ in shape: {X_std.shape} vs {X_raw.shape}.")
+    chunks = _roi_chunks(X_raw.shape[1], roi_chunk_size)
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(n_jobs, len(chunks))
+
+    if n_jobs <= 1:
+        results = []
+        for chunk in chunks:
+            results.append(template_entropy_engine(X_std[:, chunk], X_raw[:, chunk], dtype=dtype, **engine_kwargs))
+            if progress:
+                progress(len(results), len(chunks))
+    else:
+        shape = (2,) + X_raw.shape
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * X_raw.itemsize)
+        try:
+            stacked = np.ndarray(shape, dtype=X_raw.dtype, buffer=shm.buf)
+            stacked[0] = X_std
+            stacked[1] = X_raw
+            # spawn: the Flask apps run this from a threaded server, where forking is unsafe
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_attach_shared_timeseries,
+                                     initargs=(shm.name, shape, X_raw.dtype)) as pool:
+                results = []
+                for result in pool.map(_engine_on_shared_chunk, chunks, [engine_kwargs] * len(chunks)):
+                    results.append(result)
+                    if progress:
+                        progress(len(results), len(chunks))
+            del stacked
+        finally:
+            shm.close()
+            shm.unlink()
+
+    return {key: np.concatenate([res[key] for res in results]) for key in engine_kwargs['kinds']}
+
+
+# === Preview: entropies estimated from a random sample of template pairs ===
+# Template pairs drawn per ROI and entropy type in preview mode (an exact run walks all ~T^2/2 pairs)
+PREVIEW_PAIR_BUDGET = 20000
+PREVIEW_CONFIDENCE = 0.95
+
+
+def _pairs_from_linear(k, n_templates):
+    """(i, j) with i < j < n_templates of the k-th pair in row-major upper-triangle order."""
+    k = np.asarray(k, dtype=np.int64)
+    M = n_templates
+    i = M - 2 - np.floor(np.sqrt(-8.0 * k + 4.0 * M * (M - 1) - 7) / 2.0 - 0.5).astype(np.int64)
+    j = k + i + 1 - M * (M - 1) // 2 + (M - i) * (M - i - 1) // 2
+    return i, j
+
+
+def _sample_pairs(n_templates, pair_budget, rng):
+    """pair_budget pairs drawn uniformly (with replacement) from i < j, or all of them if there are not more."""
+    n_pairs = n_templates * (n_templates - 1) // 2
+    if n_pairs <= pair_budget:
+        i, j = np.triu_indices(n_templates, 1)
+        return i, j, True
+    i, j = _pairs_from_linear(rng.integers(0, n_pairs, pair_budget), n_templates)
+    return i, j, False
+
+
+def _pair_moments(X, i, j, m, pair_values, max_block_bytes=DEFAULT_MAX_BLOCK_BYTES):
+    """
+    Sums of x, y, x^2, y^2 and x*y over the pairs (i, j), per column of X, where
+    x, y = pair_values(dist_m, min_m, dist_last, has_m1) are per-pair statistics.
+    """
+    n_samples, n_rois = X.shape
+    sums = np.zeros((5, n_rois))
+    offsets = np.arange(m)
+    pairs_per_block = max(1, max_block_bytes // ((m + 4) * X.itemsize * n_rois))
+    for b0 in range(0, len(i), pairs_per_block):
+        bi, bj = i[b0:b0 + pairs_per_block], j[b0:b0 + pairs_per_block]
+        diffs = np.abs(X[bi[:, np.newaxis] + offsets] - X[bj[:, np.newaxis] + offsets])  # (pairs, m, ROI)
+        # The length-(m + 1) templates only exist for j < N - m (i < j always)
+        has_m1 = (bj + m < n_samples)[:, np.newaxis]
+        dist_last = np.abs(X[np.minimum(bi + m, n_samples - 1)] - X[np.minimum(bj + m, n_samples - 1)])
+        x, y = pair_values(diffs.max(axis=1), diffs.min(axis=1), dist_last, has_m1)
+        sums += [x.sum(axis=0), y.sum(axis=0), (x * x).sum(axis=0), (y * y).sum(axis=0), (x * y).sum(axis=0)]
+    return sums
+
+
+def _log_ratio_estimate(sums, n_draws, z, exact, coef_x=(0.0, 1.0), coef_y=(0.0, 1.0)):
+    """
+    log(a_x + b_x * mean(x)) - log(a_y + b_y * mean(y)) per ROI, with a delta-method
+    interval of +-z standard errors (zero width when every pair was used).
+    """
+    (a_x, b_x), (a_y, b_y) = coef_x, coef_y
+    mean_x, mean_y = sums[0] / n_draws, sums[1] / n_draws
+    var_x = sums[2] / n_draws - mean_x ** 2
+    var_y = sums[3] / n_draws - mean_y ** 2
+    cov_xy = sums[4] / n_draws - mean_x * mean_y
+    p_x, p_y = a_x + b_x * mean_x, a_y + b_y * mean_y
+    with np.errstate(divide='ignore', invalid='ignore'):
+        estimate = np.log(p_x) - np.log(p_y)
+        if exact:
+            half_width = np.zeros_like(estimate)
+        else:
+            g_x, g_y = b_x / p_x, -b_y / p_y
+            variance = (g_x ** 2 * var_x + g_y ** 2 * var_y + 2 * g_x * g_y * cov_xy) / max(n_draws - 1, 1)
+            half_width = z * np.sqrt(np.maximum(variance, 0.0))
+    low, high = estimate - half_width, estimate + half_width
+    unknown = ~np.isfinite(estimate)
+    low[unknown] = high[unknown] = np.nan
+    return estimate, low, high
+
+
+def _exact_where_undefined(interval, kind, X_std, X_raw, m, r_ratio, n):
+    # No sampled match (log of 0): the exact value with its conventions for those ROIs, zero-width interval
+    estimate, low, high = interval
+    undefined = np.flatnonzero(~np.isfinite(estimate))
+    if undefined.size:
+        exact = template_entropy_engine(X_std[:, undefined], X_raw[:, undefined], m=m, r_ratio=r_ratio, n=n,
+                                        kinds=(kind,))[kind]
+        estimate[undefined] = low[undefined] = high[undefined] = exact
+    return estimate, low, high
+
+
+def preview_pair_entropies(timeseries_std, timeseries_raw, kinds=PAIR_ENTROPY_TYPES, pair_budget=PREVIEW_PAIR_BUDGET,
+                           confidence=PREVIEW_CONFIDENCE, seed=0, m=2, r_ratio=0.2, n=2,
+                           max_block_bytes=DEFAULT_MAX_BLOCK_BYTES):
     """
-    if ATLAS_COORDS is None:
-        raise RuntimeError("Power2011 atlası yüklenemedi, entropi hesaplanamaz.")
+    Estimates SampEn / FuzzyEn / RangeEn per ROI from pair_budget randomly drawn
+    template pairs instead of all of them (O(pair_budget) instead of O(T^2)).
 
-    print(f"✅ Entropi hesaplaması başlatıldı: {nilearn_processed_path}")
+    Every entropy here is a log-ratio of two pair averages (match rates or fuzzy
+    similarity sums, for the m and m + 1 templates) on the same sample, so the
+    interval comes from the delta method on the two sample means and their
+    covariance. r is the exact per-ROI tolerance (r_ratio * std). With at least as
+    many budget pairs as the series has, all pairs are used and the values equal
+    template_entropy_engine's (intervals of zero width). A SampEn/RangeEn whose
+    sample has no matches at all is computed exactly for that ROI instead.
 
-    # ... (The first part of the function that extracts time series is unchanged) ...
-    masker_std = input_data.NiftiSpheresMasker(
-        seeds=ATLAS_COORDS, radius=5, detrend=True, standardize=True,
-        low_pass=0.08, high_pass=0.009, t_r=t_r
-    )
-    timeseries_std = masker_std.fit_transform(nilearn_processed_path)
+    Returns:
+        dict: {kind: (estimate, ci_low, ci_high)}, arrays with one entry per ROI;
+        the FuzzyEn interval is NaN for a flat series.
+    """
+    from statistics import NormalDist
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    rng = np.random.default_rng(seed)
+    X_std = _as_timeseries_matrix(timeseries_std)
+    X_raw = _as_timeseries_matrix(timeseries_raw)
+    n_samples = X_raw.shape[0]
+    results = {}
+
+    if 'SaEn' in kinds:
+        # antropy's convention: the first N - m templates for both lengths
+        r_std = _column_tolerances(X_std, r_ratio)
+        i, j, exact = _sample_pairs(n_samples - m, pair_budget, rng)
+        sums = _pair_moments(X_std, i, j, m, lambda dist_m, min_m, last, has_m1: (
+            (dist_m < r_std).astype(float), (np.maximum(dist_m, last) < r_std).astype(float)), max_block_bytes)
+        results['SaEn'] = _exact_where_undefined(_log_ratio_estimate(sums, len(i), z, exact), 'SaEn',
+                                                 X_std, X_raw, m, r_ratio, n)
+
+    if 'FuEn' in kinds or 'RaEn' in kinds:
+        # All N - m + 1 length-m templates; an m + 1 value counts only where those templates exist, so
+        # mean(y) * pairs(m) is the m + 1 pair total, as in the exact kernels
+        r_raw = _column_tolerances(X_raw, r_ratio)
+        r_raw_safe = np.where(r_raw > 0, r_raw, 1.0)
+        n_m, n_m1 = n_samples - m + 1, n_samples - m
+        pairs_m = n_m * (n_m - 1) / 2
+        i, j, exact = _sample_pairs(n_m, pair_budget, rng)
+        if 'FuEn' in kinds:
+            sums = _pair_moments(X_raw, i, j, m, lambda dist_m, min_m, last, has_m1: (
+                np.exp(-np.power(dist_m, n) / r_raw_safe),
+                np.exp(-np.power(np.maximum(dist_m, last), n) / r_raw_safe) * has_m1), max_block_bytes)
+            # phi = (templates + 2 * pair sum) / templates^2
+            estimate, low, high = _log_ratio_estimate(sums, len(i), z, exact,
+                                                      coef_x=(1.0 / n_m, 2 * pairs_m / n_m ** 2),
+                                                      coef_y=(1.0 / n_m1, 2 * pairs_m / n_m1 ** 2))
+            flat = r_raw <= 0
+            estimate[flat], low[flat], high[flat] = 0.0, np.nan, np.nan
+            results['FuEn'] = (estimate, low, high)
+        if 'RaEn' in kinds:
+            sums = _pair_moments(X_raw, i, j, m, lambda dist_m, min_m, last, has_m1: (
+                ((dist_m - min_m) < r_raw).astype(float),
+                (((np.maximum(dist_m, last) - np.minimum(min_m, last)) < r_raw) & has_m1).astype(float)),
+                                 max_block_bytes)
+            results['RaEn'] = _exact_where_undefined(_log_ratio_estimate(sums, len(i), z, exact), 'RaEn',
+                                                     X_std, X_raw, m, r_ratio, n)
+    return results
+
+
+def preview_entropy_features(timeseries_std, timeseries_raw, pair_budget=PREVIEW_PAIR_BUDGET,
+                             confidence=PREVIEW_CONFIDENCE, seed=0, feature_indices='all'):
+    """
+    Preview counterpart of compute_entropy_features: (features, ci_low, ci_high), each
+    a 1056 vector. SampEn/FuzzyEn/RangeEn come from preview_pair_entropies, DiffEn is
+    exact (its interval is the value). Features outside feature_indices are NaN.
+    """
+    feature_indices = normalize_feature_indices(feature_indices)
+    plan = feature_plan(feature_indices)
+    features, ci_low, ci_high = (np.full(len(ENTROPY_TYPES) * N_ROIS, np.nan) for _ in range(3))
+
+    kinds = tuple(kind for kind in PAIR_ENTROPY_TYPES if plan[kind])
+    rois = sorted(set().union(*(plan[kind] for kind in kinds))) if kinds else []
+    if rois:
+        estimates = preview_pair_entropies(np.ascontiguousarray(timeseries_std[:, rois]),
+                                           np.ascontiguousarray(timeseries_raw[:, rois]), kinds=kinds,
+                                           pair_budget=pair_budget, confidence=confidence, seed=seed)
+        position = {roi: k for k, roi in enumerate(rois)}
+        for kind, (estimate, low, high) in estimates.items():
+            offset = ENTROPY_TYPES.index(kind) * N_ROIS
+            for roi in plan[kind]:
+                features[offset + roi] = estimate[position[roi]]
+                ci_low[offset + roi] = low[position[roi]]
+                ci_high[offset + roi] = high[position[roi]]
+
+    diffen_offset = ENTROPY_TYPES.index('DiffEn') * N_ROIS
+    for roi in plan['DiffEn']:
+        features[diffen_offset + roi] = ci_low[diffen_offset + roi] = ci_high[diffen_offset + roi] = \
+            differential_entropy_custom(timeseries_raw[:, roi])
+    return _finalize_features(features, feature_indices), ci_low, ci_high
+
+
+# === Dynamic (sliding-window) entropy ===
+# Entropy types of the dynamic mode, in the order of the last axis of its output
+DYNAMIC_ENTROPY_TYPES = ('SaEn', 'FuEn')
+
+
+def _pair_distances(X, k, js, m, with_m1=True):
+    # Chebyshev distances of template k to the templates js, (len(js) x ROI), for lengths m (and m + 1)
+    dist_m = np.abs(X[k] - X[js])
+    for offset in range(1, m):
+        np.maximum(dist_m, np.abs(X[k + offset] - X[js + offset]), out=dist_m)
+    if not with_m1:
+        return dist_m
+    return dist_m, np.maximum(dist_m, np.abs(X[k + m] - X[js + m]))
+
+
+def _dynamic_pair_terms(X_std, X_raw, k, js, m, r_std, r_raw_safe, n):
+    """Per-ROI sums over the pairs (k, j in js): SaEn m / m + 1 matches, fuzzy m / m + 1 similarities."""
+    std_m, std_m1 = _pair_distances(X_std, k, js, m)
+    raw_m, raw_m1 = _pair_distances(X_raw, k, js, m)
+    return (np.count_nonzero(std_m < r_std, axis=0), np.count_nonzero(std_m1 < r_std, axis=0),
+            np.exp(-np.power(raw_m, n) / r_raw_safe).sum(axis=0),
+            np.exp(-np.power(raw_m1, n) / r_raw_safe).sum(axis=0))
+
+
+def dynamic_entropy(timeseries_std, timeseries_raw, window, step=1, m=2, r_ratio=0.2, n=2):
+    """
+    SampEn (standardized series) and FuzzyEn (raw series) of every ROI over sliding
+    windows of `window` samples, advanced by `step` samples.
+
+    r is fixed per ROI from the full series (r_ratio * std), so windows are
+    comparable and their pair statistics can be updated instead of recomputed:
+    when the window advances by one sample, the pairs of the template that leaves
+    are subtracted and those of the template that enters are added (O(window) per
+    sample instead of O(window^2) per window). Match counts are integers; fuzzy
+    sums are float64 running sums. Within a window the conventions are those of
+    the static functions (SampEn over the first window - m templates, nan without
+    any m match, inf without any m + 1 match).
 
-    masker_raw = input_data.NiftiSpheresMasker(
-        seeds=ATLAS_COORDS, radius=5, detrend=False, standardize=False,
-        low_pass=0.08, high_pass=0.009, t_r=t_r
-    )
-    timeseries_raw = masker_raw.fit_transform(nilearn_processed_path)
+    Returns:
+        np.ndarray: (windows x ROI x len(DYNAMIC_ENTROPY_TYPES)); window w starts at sample w * step.
+    """
+    X_std = _as_timeseries_matrix(timeseries_std)
+    X_raw = _as_timeseries_matrix(timeseries_raw)
+    if X_std.shape != X_raw.shape:
+        raise ValueError(f"Standardized and raw series differ in shape: {X_std.shape} vs {X_raw.shape}.")
+    n_samples, n_rois = X_raw.shape
+    if not m + 2 <= window <= n_samples:
+        raise ValueError(f"Window of {window} samples must be between {m + 2} and the series length {n_samples}.")
+    if step < 1:
+        raise ValueError("step must be at least 1.")
+
+    r_std = _column_tolerances(X_std, r_ratio)
+    r_raw = _column_tolerances(X_raw, r_ratio)
+    r_raw_safe = np.where(r_raw > 0, r_raw, 1.0)
+    starts = range(0, n_samples - window + 1, step)
+    output = np.empty((len(starts), n_rois, len(DYNAMIC_ENTROPY_TYPES)))
+
+    # Running statistics over the pairs of the window's first window - m templates
+    # (the SampEn domain, also the length-(m + 1) templates of FuzzyEn)
+    n_templates = window - m
+    saen_B = np.zeros(n_rois, dtype=np.int64)
+    saen_A = np.zeros(n_rois, dtype=np.int64)
+    fuzzy_m = np.zeros(n_rois)
+    fuzzy_m1 = np.zeros(n_rois)
+
+    def _apply(k, js, sign):
+        B, A, sum_m, sum_m1 = _dynamic_pair_terms(X_std, X_raw, k, js, m, r_std, r_raw_safe, n)
+        saen_B[:] += sign * B
+        saen_A[:] += sign * A
+        fuzzy_m[:] += sign * sum_m
+        fuzzy_m1[:] += sign * sum_m1
+
+    for k in range(1, n_templates):
+        _apply(k, np.arange(k), 1)
+
+    first = 0
+    for w, start in enumerate(starts):
+        while first < start:
+            # The window moves one sample: template `first` leaves, template `first + n_templates` enters
+            others = np.arange(first + 1, first + n_templates)
+            _apply(first, others, -1)
+            _apply(first + n_templates, others, 1)
+            first += 1
+        # FuzzyEn's length-m sum also has the window's last length-m template
+        last = first + n_templates
+        last_m = _pair_distances(X_raw, last, np.arange(first, last), m, with_m1=False)
+        last_sum = np.exp(-np.power(last_m, n) / r_raw_safe).sum(axis=0)
+
+        output[w, :, 0] = _sampen_from_counts(saen_B, saen_A)
+        output[w, :, 1] = _fuzzy_from_sums(fuzzy_m + last_sum, fuzzy_m1, window, m, r_raw)
+    return output
+
+
+def save_dynamic_entropy(dynamic, output_dir, window, step, t_r):
+    """Writes the (windows x ROI x type) array to output_dir/dynamic_entropy.npz with its window layout."""
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, 'dynamic_entropy.npz')
+    np.savez_compressed(path, dynamic_entropy=dynamic, entropy_types=np.array(DYNAMIC_ENTROPY_TYPES),
+                        window=window, step=step, t_r=t_r)
+    print(f"✅ Dinamik entropi kaydedildi: {path} {dynamic.shape}")
+    return path
+
+
+# === ROI zaman serisi çıkarımı ===
+def extract_roi_timeseries(img, t_r=2.0):
+    """
+    Loads the image once, averages the Power2011 spheres once and derives both
+    ROI matrices from those sphere signals with nilearn.signal.clean.
 
-    saen_values = [sample_entropy_custom(timeseries_std[:, i]) for i in range(N_ROIS)]
-    diffen_values = [differential_entropy_custom(timeseries_raw[:, i]) for i in range(N_ROIS)]
-    fuen_values = [fuzzy_entropy(timeseries_raw[:, i]) for i in range(N_ROIS)]
-    rangeen_values = [compute_range_entropy(timeseries_raw[:, i]) for i in range(N_ROIS)]
+    This is the same computation the two NiftiSpheresMasker instances (detrended/
+    standardized and raw) used to do, each with its own image read and extraction.
+    The sphere means come from the cached sparse operator of the image's grid
+    (sphere_operator.py), so sphere membership is not recomputed per subject. The
+    raw sphere means match the masker's to floating-point summation order (~1e-15
+    relative); the cleaned ROI matrices amplify that to ~2e-9 relative in float64
+    and ~5e-5 with float32 input.
 
-    all_features = np.concatenate([
-        saen_values, diffen_values, fuen_values, rangeen_values
-    ])
+    Returns:
+        tuple: (timeseries_std, timeseries_raw), each (T x ROI).
+    """
+    img = image.load_img(img)
+    sphere_signals = sphere_operator.sphere_signals(img, ATLAS_RADIUS)
 
-    # --- THIS IS THE NEW PART THAT SAVES THE CSV ---
-    print("💾 Entropi özellikleri CSV dosyasına kaydediliyor...")
+    filter_kwargs = dict(low_pass=ROI_LOW_PASS, high_pass=ROI_HIGH_PASS, t_r=t_r)
+    timeseries_std = signal.clean(sphere_signals, detrend=True, standardize=True, **filter_kwargs)
+    timeseries_raw = signal.clean(sphere_signals, detrend=False, standardize=False, **filter_kwargs)
+    return timeseries_std, timeseries_raw
 
-    # Create column headers for the CSV file
-    n_rois = len(saen_values)
-    headers = (
+
+# === Özellik planı: yalnızca modellerin okuduğu (ROI, entropi türü) çiftleri ===
+def feature_plan(feature_indices='all', n_rois=N_ROIS):
+    """
+    Feature vector indices (e.g. a model's feature_indices) -> {entropy type: sorted
+    0-based ROI indices} for every type in ENTROPY_TYPES. 'all' plans every feature.
+    """
+    if isinstance(feature_indices, str) and feature_indices == 'all':
+        return {kind: list(range(n_rois)) for kind in ENTROPY_TYPES}
+    plan = {kind: set() for kind in ENTROPY_TYPES}
+    for index in feature_indices:
+        index = int(index)
+        if not 0 <= index < len(ENTROPY_TYPES) * n_rois:
+            raise ValueError(f"Feature index {index} is outside the {len(ENTROPY_TYPES) * n_rois}-feature vector.")
+        plan[ENTROPY_TYPES[index // n_rois]].add(index % n_rois)
+    return {kind: sorted(rois) for kind, rois in plan.items()}
+
+
+def plan_feature_indices(plan, n_rois=N_ROIS):
+    """The feature vector indices a plan computes, sorted."""
+    return sorted(ENTROPY_TYPES.index(kind) * n_rois + roi for kind, rois in plan.items() for roi in rois)
+
+
+def normalize_feature_indices(feature_indices, n_rois=N_ROIS):
+    """'all' or the sorted unique indices; a list covering every feature also becomes 'all'."""
+    if isinstance(feature_indices, str) and feature_indices == 'all':
+        return 'all'
+    indices = plan_feature_indices(feature_plan(feature_indices, n_rois), n_rois)
+    return 'all' if len(indices) == len(ENTROPY_TYPES) * n_rois else indices
+
+
+def _finalize_features(all_features, feature_indices='all'):
+    # nan/inf of computed features -> numbers, as before; features outside the plan stay NaN
+    if isinstance(feature_indices, str) and feature_indices == 'all':
+        return np.nan_to_num(all_features)
+    finalized = np.full(len(all_features), np.nan)
+    finalized[feature_indices] = np.nan_to_num(all_features[feature_indices])
+    return finalized
+
+
+# === Özellik vektörü ve CSV ===
+def max_block_bytes_for_budget(memory_budget_mb=None):
+    """Engine block cap for a job memory budget in MB: DEFAULT_MAX_BLOCK_BYTES or less."""
+    if memory_budget_mb is None:
+        return DEFAULT_MAX_BLOCK_BYTES
+    return max(1024 ** 2, min(DEFAULT_MAX_BLOCK_BYTES, int(memory_budget_mb * 1024 ** 2 * BLOCK_SHARE_OF_BUDGET)))
+
+
+def compute_entropy_features(timeseries_std, timeseries_raw, n_jobs=1, roi_chunk_size=DEFAULT_ROI_CHUNK_SIZE,
+                             dtype=np.float64, progress=None, feature_indices='all',
+                             max_block_bytes=DEFAULT_MAX_BLOCK_BYTES):
+    """
+    ROI zaman serilerinden 1056 elemanlı özellik vektörü: [SaEn, DiffEn, FuEn, RaEn] x ROI.
+    progress(done_chunks, total_chunks) is reported per ROI chunk (see compute_pair_entropies).
+    max_block_bytes caps the engine's pair-block intermediates (same counts; FuzzyEn up to summation order).
+
+    feature_indices ('all' or vector indices, e.g. the union of the selected models'
+    feature_indices) limits the work to those (ROI, entropy type) pairs; features
+    outside the plan are NaN. Computed values match a full run (FuzzyEn up to the
+    float64 summation order of the pair blocks).
+    """
+    plan = {kind: set(rois) for kind, rois in feature_plan(feature_indices).items()}
+    all_features = np.full(len(ENTROPY_TYPES) * N_ROIS, np.nan)
+
+    # ROIs grouped by the pair entropies they need: one engine pass per group, over just its columns.
+    # SampEn, FuzzyEn and RangeEn of a ROI share one template-pair pass (the full plan is a single group).
+    groups = {}
+    for roi in range(N_ROIS):
+        kinds = tuple(kind for kind in PAIR_ENTROPY_TYPES if roi in plan[kind])
+        if kinds:
+            groups.setdefault(kinds, []).append(roi)
+    total_chunks = sum(len(_roi_chunks(len(rois), roi_chunk_size)) for rois in groups.values())
+    done_chunks = 0
+    for kinds, rois in groups.items():
+        group_progress = None
+        if progress:
+            group_progress = lambda done, total, offset=done_chunks: progress(offset + done, total_chunks)
+        # C order like the full matrix (fancy indexing may return another layout, which changes the einsum order)
+        group_std = np.ascontiguousarray(timeseries_std[:, rois])
+        group_raw = np.ascontiguousarray(timeseries_raw[:, rois])
+        pair_entropies = compute_pair_entropies(group_std, group_raw, n_jobs=n_jobs,
+                                                roi_chunk_size=roi_chunk_size, dtype=dtype,
+                                                progress=group_progress, kinds=kinds,
+                                                max_block_bytes=max_block_bytes)
+        for kind, values in pair_entropies.items():
+            all_features[ENTROPY_TYPES.index(kind) * N_ROIS + np.asarray(rois)] = values
+        done_chunks += len(_roi_chunks(len(rois), roi_chunk_size))
+
+    diffen_offset = ENTROPY_TYPES.index('DiffEn') * N_ROIS
+    for roi in sorted(plan['DiffEn']):
+        all_features[diffen_offset + roi] = differential_entropy_custom(timeseries_raw[:, roi])
+    return all_features
+
+
+def feature_column_names(n_rois=N_ROIS):
+    """Column names of the feature vector, in its order (entropy type major, then ROI)."""
+    return (
             [f"sample_entropy_roi_{i + 1}" for i in range(n_rois)] +
             [f"differential_entropy_roi_{i + 1}" for i in range(n_rois)] +
             [f"fuzzy_entropy_roi_{i + 1}" for i in range(n_rois)] +
             [f"range_entropy_roi_{i + 1}" for i in range(n_rois)]
     )
 
+
+def save_entropy_features_csv(all_features, output_dir, feature_indices='all'):
+    """
+    Özellik vektörünü output_dir/entropy_features.csv olarak tek satır halinde kaydeder.
+    With a partial plan only the planned features get a column (named as in
+    feature_column_names), not 1056 columns that are mostly NaN.
+    """
+    print("💾 Entropi özellikleri CSV dosyasına kaydediliyor...")
+
+    # Create column headers for the CSV file
+    headers = feature_column_names(len(all_features) // 4)
+    values = np.asarray(all_features)
+    if not (isinstance(feature_indices, str) and feature_indices == 'all'):
+        headers = [headers[i] for i in feature_indices]
+        values = values[np.asarray(feature_indices, dtype=np.intp)]
+
     # Convert the numpy array to a pandas DataFrame
     # We need to reshape the 1D array to a 2D array with one row
-    features_df = pd.DataFrame(all_features.reshape(1, -1), columns=headers)
-
-    # Define where to save the CSV file
-    output_dir = os.path.dirname(nilearn_processed_path)
-    csv_path = os.path.join(output_dir, 'entropy_features.csv')
+    features_df = pd.DataFrame(values.reshape(1, -1), columns=headers)
 
     # Save the DataFrame to a CSV file
+    os.makedirs(output_dir, exist_ok=True)
+    csv_path = os.path.join(output_dir, 'entropy_features.csv')
     features_df.to_csv(csv_path, index=False)
     print(f"✅ CSV dosyası başarıyla kaydedildi: {csv_path}")
+    return csv_path
+
+
+def build_entropy_stages(t_r=2.0, n_jobs=1, roi_chunk_size=DEFAULT_ROI_CHUNK_SIZE, dtype=np.float64,
+                         output_dir=None, progress=None, feature_indices='all', memory_budget_mb=None):
+    """
+    ROI extraction and entropy as checkpointable stages (see checkpoints.run_stages):
+    processed image -> (timeseries_std, timeseries_raw) -> (features, timeseries_std, timeseries_raw).
+    progress(done_chunks, total_chunks) and feature_indices are passed on to compute_entropy_features.
+    memory_budget_mb sizes the pair blocks (max_block_bytes_for_budget) and fails the
+    entropy stage if it pushes the RSS over budget.
+    """
+    feature_indices = normalize_feature_indices(feature_indices)
+
+    def _entropy(timeseries):
+        timeseries_std, timeseries_raw = timeseries
+        budget = MemoryBudget(memory_budget_mb, label='entropy')
+        all_features = compute_entropy_features(timeseries_std, timeseries_raw, n_jobs=n_jobs,
+                                                roi_chunk_size=roi_chunk_size, dtype=dtype, progress=progress,
+                                                feature_indices=feature_indices,
+                                                max_block_bytes=max_block_bytes_for_budget(memory_budget_mb))
+        budget.check('entropy')
+        if output_dir is not None:
+            save_entropy_features_csv(all_features, output_dir, feature_indices)
+        return _finalize_features(all_features, feature_indices), timeseries_std, timeseries_raw
+
+    # n_jobs/roi_chunk_size do not change the numbers, so they stay out of the keys
+    return [
+        Stage('roi_extraction', {'atlas': 'power_2011', 'radius': ATLAS_RADIUS, 'low_pass': ROI_LOW_PASS,
+                                 'high_pass': ROI_HIGH_PASS, 't_r': t_r},
+              lambda img: extract_roi_timeseries(img, t_r=t_r), 'arrays'),
+        Stage('entropy', {'dtype': np.dtype(dtype).name, 'features': feature_indices}, _entropy, 'arrays'),
+    ]
+
+
+# === ANA FONKSİYON ===
+def calculate_entropy_features(nilearn_processed_path, t_r=2.0, n_jobs=1, roi_chunk_size=DEFAULT_ROI_CHUNK_SIZE,
+                               dtype=np.float64, output_dir=None, return_timeseries=False, feature_indices='all',
+                               memory_budget_mb=None):
+    """
+    Nilearn ile işlenmiş tek bir NIfTI dosyasını (ya da bellekteki görüntüyü) alır,
+    ROI zaman serilerini çıkarır ve tüm entropi özelliklerini hesaplar.
+
+    Args:
+        nilearn_processed_path (str or Nifti1Image): Nilearn pipeline'ından gelen son dosyanın yolu
+            veya run_nilearn_processing(return_img=True) ile dönen görüntü.
+        t_r (float): Repetition time.
+        n_jobs (int): Worker processes for the per-ROI entropies (1 = serial, -1 = all cores).
+        roi_chunk_size (int): ROIs per worker task.
+        dtype: np.float32 runs the entropy kernels in single precision (see run_nilearn_processing
+            for the expected differences against float64).
+        output_dir (str): Where entropy_features.csv is written; defaults to the folder of the
+            input file. For an in-memory image without output_dir the CSV is skipped.
+        return_timeseries (bool): Also return the (T x ROI) standardized and raw ROI series.
+        feature_indices: 'all' (default) or the feature vector indices to compute, e.g. the
+            union of the selected models' feature_indices; the other features are NaN
+            (and have no column in entropy_features.csv).
+        memory_budget_mb (float): Job memory budget; sizes the pair blocks and is checked after
+            the entropy stage (see build_entropy_stages).
+
+    Returns:
+        np.ndarray: Makine öğrenmesi modeli için girdi olabilecek 1D bir özellik vektörü
+        (return_timeseries=True ise (features, timeseries_std, timeseries_raw)).
+    """
+    is_path = isinstance(nilearn_processed_path, (str, os.PathLike))
+    print(f"✅ Entropi hesaplaması başlatıldı: {nilearn_processed_path if is_path else 'in-memory image'}")
+
+    # Tek okuma, tek küre çıkarımı: std ve ham seriler aynı sinyallerden türetilir
+    timeseries_std, timeseries_raw = extract_roi_timeseries(nilearn_processed_path, t_r=t_r)
+
+    feature_indices = normalize_feature_indices(feature_indices)
+    budget = MemoryBudget(memory_budget_mb, label='entropy')
+    all_features = compute_entropy_features(timeseries_std, timeseries_raw, n_jobs=n_jobs,
+                                            roi_chunk_size=roi_chunk_size, dtype=dtype,
+                                            feature_indices=feature_indices,
+                                            max_block_bytes=max_block_bytes_for_budget(memory_budget_mb))
+    budget.check('entropy')
+
+    # --- THIS IS THE NEW PART THAT SAVES THE CSV ---
+    if output_dir is None and is_path:
+        output_dir = os.path.dirname(nilearn_processed_path)
+    if output_dir is None:
+        print("ℹ️ No output_dir for an in-memory image, skipping the CSV file.")
+    else:
+        save_entropy_features_csv(all_features, output_dir, feature_indices)
     # -----------------------------------------------
 
     # Return the features as before
-    return np.nan_to_num(all_features)
\ No newline at end of file
+    if return_timeseries:
+        return _finalize_features(all_features, feature_indices), timeseries_std, timeseries_raw
+    return _finalize_features(all_features, feature_indices)
+
+
+def calculate_dynamic_entropy(nilearn_processed_path, window, step=1, t_r=2.0, output_dir=None, dtype=np.float32):
+    """
+    Dinamik entropi modu: calculate_entropy_features ile aynı ROI zaman serilerinden,
+    kayan pencerelerde SampEn/FuzzyEn (bkz. dynamic_entropy).
+
+    Args:
+        window (int): Window length in samples (TRs).
+        step (int): Samples between window starts.
+        output_dir (str): Where dynamic_entropy.npz is written; defaults to the folder of the
+            input file, skipped for an in-memory image without output_dir.
+        dtype: dtype of the returned array (float32 keeps it compact; computed in float64).
+
+    Returns:
+        np.ndarray: (windows x ROI x len(DYNAMIC_ENTROPY_TYPES)).
+    """
+    is_path = isinstance(nilearn_processed_path, (str, os.PathLike))
+    timeseries_std, timeseries_raw = extract_roi_timeseries(nilearn_processed_path, t_r=t_r)
+    dynamic = dynamic_entropy(timeseries_std, timeseries_raw, window, step=step).astype(dtype)
+    if output_dir is None and is_path:
+        output_dir = os.path.dirname(nilearn_processed_path)
+    if output_dir is not None:
+        save_dynamic_entropy(dynamic, output_dir, window, step, t_r)
+    return dynamic
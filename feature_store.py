@@ -0,0 +1,232 @@
+# ==============================================================================
+# === feature_store.py (Appendable binary feature matrix with a row index) =====
+# ==============================================================================
+import csv
+import fcntl
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# Directory of the store used by the app and the cohort runner when enabled
+DEFAULT_FEATURE_STORE_DIR = 'features'
+STORE_VERSION = 2
+
+_DATA_FILE = 'features.f64'
+_INDEX_FILE = 'index.csv'
+_META_FILE = 'meta.json'
+_LOCK_FILE = 'lock'
+INDEX_COLUMNS = ['row', 'subject', 'job_id', 'content_hash', 'plan', 'created_at']
+# Plan of a row holding every feature
+FULL_PLAN = 'all'
+
+
+class FeatureStore:
+    """
+    Feature vectors of many subjects in one file: features.f64 is a raw
+    (rows x n_features) little-endian float64 matrix, row-major, and index.csv
+    maps each row to its subject, job id, content hash (the result-cache key
+    of the inputs + parameters) and plan. Values are stored bit-exact, no text
+    round trip.
+
+    A row may hold only some features (the app's 'models' feature plan): the
+    others are stored as NaN and the row's plan ('all', or the id of the
+    feature-index list kept in meta.json) says which ones were computed, so
+    find(columns=...) returns only rows that really have those features.
+
+    append() takes an exclusive flock, writes the row at the end of the matrix,
+    then adds its index line, so concurrent jobs (any process) never interleave.
+    A row whose index line was never written (crash in between) is overwritten
+    by the next append. Reads are lock-free: the matrix is memory-mapped up to
+    the rows the index knows about. read_matrix(columns=...) copies out only the
+    requested feature columns, but being row-major it still reads every row it
+    returns from disk. to_frame() takes the index once and maps exactly that
+    many rows, so a concurrent append never leaves the index and the matrix with
+    different lengths.
+    """
+
+    def __init__(self, root=DEFAULT_FEATURE_STORE_DIR, n_features=1056):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        with self._locked():
+            if not os.path.exists(self._meta_path):
+                self._write_meta({'n_features': int(n_features), 'dtype': '<f8', 'version': STORE_VERSION,
+                                  'plans': {}})
+                open(os.path.join(self.root, _DATA_FILE), 'ab').close()
+                with open(os.path.join(self.root, _INDEX_FILE), 'w', newline='') as f:
+                    csv.writer(f).writerow(INDEX_COLUMNS)
+            elif self._read_meta()['version'] < STORE_VERSION:
+                self._upgrade()
+        meta = self._read_meta()
+        if meta['n_features'] != n_features:
+            raise ValueError(f"Feature store {self.root} holds {meta['n_features']} features per row, "
+                             f"not {n_features}.")
+        self.n_features = meta['n_features']
+        self.dtype = np.dtype(meta['dtype'])
+        self._plans = meta['plans']
+        self._index = []
+        self._index_size = 0
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.root, _META_FILE)
+
+    def _read_meta(self):
+        with open(self._meta_path) as f:
+            return json.load(f)
+
+    def _write_meta(self, meta):
+        tmp_path = f"{self._meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _upgrade(self):
+        # Version 1 stores held full vectors only: their rows get the 'all' plan
+        path = os.path.join(self.root, _INDEX_FILE)
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        with open(path + '.tmp', 'w', newline='') as f:
+            writer = csv.DictWriter(f, INDEX_COLUMNS)
+            writer.writeheader()
+            writer.writerows(dict(row, plan=FULL_PLAN) for row in rows)
+        os.replace(path + '.tmp', path)
+        meta = self._read_meta()
+        meta.update(version=STORE_VERSION, plans={})
+        self._write_meta(meta)
+        print(f"🔧 Feature store {self.root} upgraded to version {STORE_VERSION}.")
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.root, _LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # --- Index --------------------------------------------------------------
+    def index(self):
+        """Index rows as dicts (row, subject, job_id, content_hash, created_at), re-read only when it grew."""
+        path = os.path.join(self.root, _INDEX_FILE)
+        size = os.path.getsize(path)
+        if size != self._index_size:
+            with open(path, newline='') as f:
+                rows = list(csv.DictReader(f))
+            for row in rows:
+                row['row'] = int(row['row'])
+                row['created_at'] = float(row['created_at'])
+            self._index, self._index_size = rows, size
+        return self._index
+
+    def __len__(self):
+        return len(self.index())
+
+    def find(self, subject=None, job_id=None, content_hash=None, columns=None):
+        """Row numbers matching every given key, oldest first; with columns, only rows that computed them all."""
+        return [row['row'] for row in self.index()
+                if (subject is None or row['subject'] == subject)
+                and (job_id is None or row['job_id'] == job_id)
+                and (content_hash is None or row['content_hash'] == content_hash)
+                and (columns is None or self.covers(row['plan'], columns))]
+
+    # --- Plans ----------------------------------------------------------------
+    @staticmethod
+    def plan_id(columns):
+        """Plan of a row computed for the given feature indices ('all' or None for every feature)."""
+        if columns is None or (isinstance(columns, str) and columns == FULL_PLAN):
+            return FULL_PLAN
+        payload = json.dumps(sorted(int(i) for i in columns))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+    def plan_columns(self, plan):
+        """Feature indices a plan computed, None for the full plan."""
+        if plan == FULL_PLAN:
+            return None
+        if plan not in self._plans:
+            self._plans = self._read_meta()['plans']  # added by another process
+        return np.asarray(self._plans[plan], dtype=np.intp)
+
+    def covers(self, plan, columns):
+        planned = self.plan_columns(plan)
+        return planned is None or bool(np.isin(np.asarray(columns, dtype=np.intp), planned).all())
+
+    # --- Write ----------------------------------------------------------------
+    def append(self, features, subject='', job_id='', content_hash='', columns=None):
+        """
+        Appends one feature vector; returns its row number. columns: the feature
+        indices that were computed (None or 'all' for every one); the rest are stored as NaN.
+        """
+        features = np.array(features, dtype=self.dtype).ravel()
+        if features.size != self.n_features:
+            raise ValueError(f"Expected {self.n_features} features, got {features.size}.")
+        plan = self.plan_id(columns)
+        if plan != FULL_PLAN:
+            unplanned = np.ones(self.n_features, dtype=bool)
+            unplanned[np.asarray(columns, dtype=np.intp)] = False
+            features[unplanned] = np.nan
+        row_bytes = self.n_features * self.dtype.itemsize
+        with self._locked():
+            if plan != FULL_PLAN:
+                meta = self._read_meta()
+                if plan not in meta['plans']:
+                    meta['plans'][plan] = sorted(int(i) for i in columns)
+                    self._write_meta(meta)
+                self._plans = meta['plans']
+            row = len(self.index())
+            fd = os.open(os.path.join(self.root, _DATA_FILE), os.O_WRONLY)
+            try:
+                os.pwrite(fd, features.tobytes(), row * row_bytes)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            with open(os.path.join(self.root, _INDEX_FILE), 'a', newline='') as f:
+                csv.writer(f).writerow([row, subject, job_id, content_hash, plan, f"{time.time():.3f}"])
+        return row
+
+    # --- Read -----------------------------------------------------------------
+    def _matrix(self, n_rows=None):
+        # n_rows: a row count the caller already took from the index (one snapshot for both)
+        if n_rows is None:
+            n_rows = len(self.index())
+        if n_rows == 0:
+            return np.empty((0, self.n_features), dtype=self.dtype)
+        return np.memmap(os.path.join(self.root, _DATA_FILE), dtype=self.dtype, mode='r',
+                         shape=(n_rows, self.n_features))
+
+    def read_matrix(self, rows=None, columns=None, n_rows=None):
+        """(rows x columns) array, all of either when None; columns are feature indices."""
+        matrix = self._matrix(n_rows)
+        if rows is not None:
+            matrix = matrix[np.asarray(rows, dtype=np.intp)]
+        if columns is not None:
+            matrix = matrix[:, np.asarray(columns, dtype=np.intp)]
+        return np.array(matrix)
+
+    def get(self, subject=None, job_id=None, content_hash=None, columns=None):
+        """Latest feature vector matching the keys (and computed for columns, if given), or None."""
+        rows = self.find(subject, job_id, content_hash, columns)
+        return self.read_matrix(rows=rows[-1:])[0] if rows else None
+
+    def to_frame(self, columns=None, column_names=None):
+        """
+        Index + features as a DataFrame (one row per stored vector), e.g. for
+        ml_predictor.predict_batch. Features a row's plan did not compute are NaN.
+        """
+        import pandas as pd
+
+        index = self.index()  # replaced, never mutated, by later reads: a stable snapshot
+        if column_names is None:
+            # The pipeline's own names, so predict_batch can pick the columns by name
+            from entropy_calculator import feature_column_names
+            column_names = feature_column_names()
+            if len(column_names) != self.n_features:
+                column_names = [f"feature_{i}" for i in range(self.n_features)]
+        selected = range(self.n_features) if columns is None else columns
+        frame = pd.DataFrame(self.read_matrix(columns=columns, n_rows=len(index)), columns=[column_names[i] for i in selected])
+        for key in reversed(INDEX_COLUMNS[1:5]):
+            frame.insert(0, key, [row[key] for row in index])
+        return frame
@@ -0,0 +1,243 @@
+# ==============================================================================
+# === job_scheduler.py (Bounded process workers, priority queue, admission) ====
+# ==============================================================================
+import heapq
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+
+# Worker processes running jobs at the same time
+DEFAULT_WORKERS = int(os.environ.get('NEUROSCOPE_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+# Jobs allowed to wait; beyond this submit() raises QueueFull (HTTP 429)
+DEFAULT_MAX_QUEUE = int(os.environ.get('NEUROSCOPE_MAX_QUEUE', 20))
+# Admission control: a job only starts if this much memory is available and the load is below the limit
+DEFAULT_JOB_MEMORY_MB = int(os.environ.get('NEUROSCOPE_JOB_MEMORY_MB', 4096))
+DEFAULT_MAX_LOAD_PER_CPU = float(os.environ.get('NEUROSCOPE_MAX_LOAD_PER_CPU', 1.5))
+# 'forkserver': job processes are forked from a single-threaded server that imported the heavy modules
+# once, so a job starts in milliseconds and the threaded app process itself never forks.
+# 'spawn' where forkserver is unavailable (a job then re-imports everything it uses).
+DEFAULT_START_METHOD = os.environ.get(
+    'NEUROSCOPE_WORKER_START_METHOD',
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+PRIORITIES = {'high': 0, 'normal': 10, 'low': 20}
+
+# How often the dispatcher re-checks admission while jobs are waiting
+ADMISSION_POLL_SECONDS = 1.0
+
+# Set in worker processes: job updates go back to the parent through this queue
+_worker_updates = None
+
+
+class QueueFull(Exception):
+    """The queue already holds max_queue jobs."""
+
+    def __init__(self, depth, retry_after):
+        super().__init__(f"Job queue is full ({depth} jobs waiting), retry in ~{retry_after} s.")
+        self.depth = depth
+        self.retry_after = retry_after
+
+
+def available_memory_mb():
+    """MemAvailable from /proc/meminfo in MB, or None where it cannot be read."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def load_per_cpu():
+    """1-minute load average per CPU, or None where it is not available."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def _run_job(updates, target, job_id, args):
+    """Entry point of a worker process."""
+    global _worker_updates
+    _worker_updates = updates
+    try:
+        target(job_id, *args)
+    except Exception as e:
+        updates.put((job_id, {'status': 'error', 'error': str(e)}))
+
+
+class JobScheduler:
+    """
+    Runs jobs in at most n_workers worker processes, one process per job, so a
+    job's multi-GB arrays are returned to the OS when it ends and the entropy
+    loops of different jobs do not share a GIL.
+
+    Waiting jobs are ordered by (priority, submission order). A job only starts
+    when a worker slot is free and admission control passes (enough available
+    memory, CPU load below the limit); with nothing running the next job is
+    always admitted so the queue cannot stall. submit() raises QueueFull once
+    max_queue jobs are waiting.
+
+    Job progress is reported with update(job_id, **fields): in a worker it is
+    sent back through a queue, in the parent it goes straight to on_update.
+
+    With the forkserver start method, preload names the modules the fork server
+    imports before forking any job (plus the target's own module), e.g. the
+    heavy NiLearn/entropy modules the app itself only imports lazily.
+    """
+
+    def __init__(self, target, on_update, n_workers=DEFAULT_WORKERS, max_queue=DEFAULT_MAX_QUEUE,
+                 job_memory_mb=DEFAULT_JOB_MEMORY_MB, max_load_per_cpu=DEFAULT_MAX_LOAD_PER_CPU,
+                 start_method=DEFAULT_START_METHOD, preload=()):
+        self.target = target
+        self.on_update = on_update
+        self.n_workers = max(1, n_workers)
+        self.max_queue = max_queue
+        self.job_memory_mb = job_memory_mb
+        self.max_load_per_cpu = max_load_per_cpu
+        self._context = multiprocessing.get_context(start_method)
+        self.preload = [target.__module__] + [name for name in preload if name != target.__module__]
+        self._updates = None
+        self._queue = []  # heap of (priority, seq, job_id, args, submitted_at)
+        self._seq = itertools.count()
+        self._running = {}  # job_id -> (process, started_at)
+        self._cond = threading.Condition()
+        self._started = False
+        # Average job duration, for the Retry-After estimate
+        self._avg_job_seconds = None
+
+    # --- Public API -------------------------------------------------------
+    def submit(self, job_id, args=(), priority='normal'):
+        """Queues a job and returns its 1-based queue position; raises QueueFull when saturated."""
+        with self._cond:
+            self._ensure_started()
+            if len(self._queue) >= self.max_queue:
+                raise QueueFull(len(self._queue), self._retry_after())
+            submitted_at = time.time()
+            heapq.heappush(self._queue, (PRIORITIES.get(priority, PRIORITIES['normal']), next(self._seq),
+                                         job_id, tuple(args), submitted_at))
+            position = self._position(job_id)
+            self.on_update(job_id, {'status': 'queued', 'submitted_at': submitted_at, 'priority': priority,
+                                    'queue_position': position})
+            self._cond.notify_all()
+        return position
+
+    def update(self, job_id, **fields):
+        """Job progress from the pipeline; works in worker processes and in the parent."""
+        if _worker_updates is not None:
+            _worker_updates.put((job_id, fields))
+        else:
+            self.on_update(job_id, fields)
+
+    def queue_info(self, job_id=None):
+        """Queue depth, busy workers and (for a job) its current position, 0 once running."""
+        with self._cond:
+            info = {'queue_depth': len(self._queue), 'running_jobs': len(self._running),
+                    'workers': self.n_workers}
+            if job_id is not None:
+                info['queue_position'] = self._position(job_id)
+        return info
+
+    # --- Internals --------------------------------------------------------
+    def _ensure_started(self):
+        # Threads and the update queue are created on first use, so importing the app
+        # (e.g. in a spawned worker) never starts a second dispatcher
+        if self._started:
+            return
+        self._updates = self._context.Queue()
+        if self._context.get_start_method() == 'forkserver':
+            self._context.set_forkserver_preload(self.preload)
+        threading.Thread(target=self._dispatch_loop, name='job-dispatcher', daemon=True).start()
+        threading.Thread(target=self._update_loop, name='job-updates', daemon=True).start()
+        self._started = True
+
+    def _position(self, job_id):
+        if job_id in self._running:
+            return 0
+        ordered = sorted(self._queue)
+        for idx, entry in enumerate(ordered):
+            if entry[2] == job_id:
+                return idx + 1
+        return None
+
+    def _retry_after(self):
+        per_job = self._avg_job_seconds or 60.0
+        return int(per_job * (len(self._queue) / self.n_workers + 1))
+
+    def _admit(self):
+        if not self._running:
+            return True
+        free_mb = available_memory_mb()
+        if free_mb is not None and free_mb < self.job_memory_mb:
+            return False
+        load = load_per_cpu()
+        if load is not None and load > self.max_load_per_cpu:
+            return False
+        return True
+
+    def _reap(self):
+        for job_id, (process, started_at) in list(self._running.items()):
+            if process is None or process.is_alive():
+                continue  # None: slot reserved, process still being started
+            process.join()
+            del self._running[job_id]
+            duration = time.time() - started_at
+            self._avg_job_seconds = duration if self._avg_job_seconds is None else \
+                0.8 * self._avg_job_seconds + 0.2 * duration
+            if process.exitcode != 0:
+                # Killed (e.g. by the OOM killer) before it could report an error itself
+                self._updates.put((job_id, {'status': 'error',
+                                            'error': f"Worker process exited with code {process.exitcode}"}))
+
+    def _warm_up_fork_server(self):
+        # Starts the fork server (and its preload imports) now instead of on the first job
+        if self._context.get_start_method() != 'forkserver':
+            return
+        from multiprocessing import forkserver
+        try:
+            forkserver.ensure_running()
+        except Exception as e:
+            print(f"⚠️ Could not start the job fork server yet: {e}")
+
+    def _dispatch_loop(self):
+        self._warm_up_fork_server()
+        while True:
+            with self._cond:
+                self._reap()
+                while not (self._queue and len(self._running) < self.n_workers and self._admit()):
+                    self._cond.wait(timeout=ADMISSION_POLL_SECONDS)
+                    self._reap()
+                _, _, job_id, args, submitted_at = heapq.heappop(self._queue)
+                started_at = time.time()
+                self._running[job_id] = (None, started_at)  # the slot is taken before the lock is released
+
+            # Job store write and process start happen outside the lock, so submit()/queue_info() never wait on them
+            self.on_update(job_id, {'status': 'preprocessing', 'started_at': started_at,
+                                    'wait_seconds': round(started_at - submitted_at, 3), 'queue_position': 0})
+            process = self._context.Process(target=_run_job, args=(self._updates, self.target, job_id, args),
+                                            name=f"job-{job_id}")  # not daemonic: jobs may start their own pools
+            try:
+                process.start()
+            except Exception as e:
+                with self._cond:
+                    del self._running[job_id]
+                    self._cond.notify_all()
+                self.on_update(job_id, {'status': 'error', 'error': f"Could not start the job process: {e}"})
+                continue
+            with self._cond:
+                self._running[job_id] = (process, started_at)
+                busy = len(self._running)
+            print(f"🏃 Job {job_id} started after {started_at - submitted_at:.1f} s in the queue "
+                  f"({busy}/{self.n_workers} workers busy).")
+
+    def _update_loop(self):
+        while True:
+            job_id, fields = self._updates.get()
+            try:
+                self.on_update(job_id, fields)
+            except Exception as e:
+                print(f"⚠️ Could not apply update for job {job_id}: {e}")
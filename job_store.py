@@ -0,0 +1,332 @@
+# ==============================================================================
+# === job_store.py (Persistent job state shared by all app processes) ==========
+# ==============================================================================
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# 'sqlite:///path/to/jobs.db' (default) or 'memory://' (development: lives in the app process only; the
+# job worker processes never read it, their updates reach it through the scheduler's update queue)
+DEFAULT_JOB_STORE_URL = 'sqlite:///jobs/jobs.db'
+# Finished jobs (completed / error) are deleted this long after they finished
+DEFAULT_TTL_SECONDS = 24 * 3600
+FINISHED_STATUSES = ('completed', 'error')
+# Expired jobs are purged at most this often, piggybacking on writes
+EXPIRE_INTERVAL_SECONDS = 300
+# wait_for_update() wakes up at once for writes made by this process (e.g. the job updates the scheduler
+# applies) and reads the version this often to see writes made by other processes
+CHANGE_POLL_SECONDS = 2.0
+# Local write counters kept for wait_for_update(); beyond this many jobs they are reset (a spurious wake-up)
+MAX_TRACKED_JOBS = 10000
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'), default=float)
+
+
+class JobStore(abc.ABC):
+    """
+    Interface of a job store: create/update merge fields into a job's state,
+    get returns the merged state (or None), expire deletes finished jobs older
+    than the TTL. Every write bumps the job's version, which wait_for_update()
+    watches to push progress (e.g. over SSE) without re-sending unchanged state.
+    """
+
+    # False for stores only this process can write to: wait_for_update() then never polls
+    shared_between_processes = True
+
+    def __init__(self, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._changed = threading.Condition()
+        self._local_writes = {}  # job_id -> writes made by this process
+        self._last_expire = 0.0
+
+    def _notify(self, job_id):
+        with self._changed:
+            if len(self._local_writes) >= MAX_TRACKED_JOBS:
+                self._local_writes.clear()
+            self._local_writes[job_id] = self._local_writes.get(job_id, 0) + 1
+            self._changed.notify_all()
+
+    def _maybe_expire(self, now):
+        # Piggybacks on writes, at most once per EXPIRE_INTERVAL_SECONDS instead of on every progress tick
+        if now - self._last_expire > EXPIRE_INTERVAL_SECONDS:
+            self.expire()
+
+    @abc.abstractmethod
+    def version(self, job_id):
+        """Number of writes to the job so far, None if it does not exist."""
+
+    def wait_for_update(self, job_id, since_version, timeout):
+        """
+        Blocks until the job's version is no longer since_version or timeout passes; returns the version.
+        Writes from this process wake it up at once without touching the store; writes from other
+        processes are seen by reading the version every CHANGE_POLL_SECONDS.
+        """
+        deadline = time.time() + timeout
+        with self._changed:
+            writes = self._local_writes.get(job_id, 0)
+        version = self.version(job_id)
+        while version == since_version:
+            now = time.time()
+            if now >= deadline:
+                break
+            wake_at = min(deadline, now + CHANGE_POLL_SECONDS) if self.shared_between_processes else deadline
+            with self._changed:
+                self._changed.wait_for(lambda: self._local_writes.get(job_id, 0) != writes,
+                                       timeout=wake_at - now)
+                writes = self._local_writes.get(job_id, 0)
+            version = self.version(job_id)
+        return version
+
+    @abc.abstractmethod
+    def create(self, job_id, fields):
+        """Stores a new job (replacing any job with that id)."""
+
+    @abc.abstractmethod
+    def update(self, job_id, fields):
+        """Merges fields into the job's state, creating it if needed."""
+
+    @abc.abstractmethod
+    def get(self, job_id):
+        """The job's merged state as a dict, None if it does not exist."""
+
+    @abc.abstractmethod
+    def delete(self, job_id):
+        """Removes the job; no-op for an unknown id."""
+
+    @abc.abstractmethod
+    def expire(self):
+        """Deletes finished jobs older than the TTL; returns how many."""
+
+    def __contains__(self, job_id):
+        return self.get(job_id) is not None
+
+
+class MemoryJobStore(JobStore):
+    """
+    The old module-level dict behind the JobStore interface (one process only).
+    Any other process, e.g. a forked job worker, gets a RuntimeError instead of
+    an empty or diverging copy of the jobs.
+    """
+
+    shared_between_processes = False
+
+    def __init__(self, ttl_seconds=DEFAULT_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self._jobs = {}
+        self._versions = {}
+        self._finished_at = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _owner_only(self):
+        if os.getpid() != self._pid:
+            raise RuntimeError("The memory:// job store only exists in the process that created it; "
+                               "pass job data to worker processes as job arguments, or use a sqlite:/// store.")
+
+    def create(self, job_id, fields):
+        self._owner_only()
+        with self._lock:
+            self._jobs[job_id] = dict(fields)
+            self._versions[job_id] = self._versions.get(job_id, 0) + 1
+        self._notify(job_id)
+
+    def update(self, job_id, fields):
+        self._owner_only()
+        now = time.time()
+        with self._lock:
+            self._jobs.setdefault(job_id, {}).update(fields)
+            self._versions[job_id] = self._versions.get(job_id, 0) + 1
+            if fields.get('status') in FINISHED_STATUSES:
+                self._finished_at[job_id] = now
+        self._notify(job_id)
+        self._maybe_expire(now)
+
+    def version(self, job_id):
+        self._owner_only()
+        with self._lock:
+            return self._versions.get(job_id)
+
+    def get(self, job_id):
+        self._owner_only()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def delete(self, job_id):
+        self._owner_only()
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._versions.pop(job_id, None)
+            self._finished_at.pop(job_id, None)
+        self._notify(job_id)
+
+    def expire(self):
+        self._owner_only()
+        self._last_expire = time.time()
+        cutoff = self._last_expire - self.ttl_seconds
+        with self._lock:
+            expired = [job_id for job_id, finished in self._finished_at.items() if finished < cutoff]
+            for job_id in expired:
+                self._jobs.pop(job_id, None)
+                self._versions.pop(job_id, None)
+                del self._finished_at[job_id]
+        return len(expired)
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Jobs in one SQLite table in WAL mode, so any number of processes on the node
+    (gunicorn workers, job workers) read and write the same state: readers never
+    block the writer, and writers wait on busy_timeout instead of failing.
+
+    job_id is the primary key of a WITHOUT ROWID table (one B-tree lookup per
+    /status). status/progress are columns; the remaining fields are compact JSON
+    and the results zlib-compressed compact JSON. Each update is a read-merge-write
+    inside BEGIN IMMEDIATE, so concurrent updates to one job never lose fields.
+    """
+
+    _SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS jobs (
+               job_id TEXT PRIMARY KEY,
+               status TEXT,
+               progress REAL,
+               fields TEXT NOT NULL,
+               results BLOB,
+               updated_at REAL NOT NULL,
+               finished_at REAL,
+               version INTEGER NOT NULL DEFAULT 1
+           ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at)',
+    )
+
+    def __init__(self, path, ttl_seconds=DEFAULT_TTL_SECONDS, busy_timeout_ms=10000):
+        super().__init__(ttl_seconds)
+        self.path = os.path.abspath(path)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._transaction() as conn:
+            for statement in self._SCHEMA:
+                conn.execute(statement)
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]
+            if 'version' not in columns:  # store created before versions existed
+                conn.execute('ALTER TABLE jobs ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+
+    def _conn(self):
+        # One connection per thread and process: sqlite3 connections must not cross either
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._conn())
+
+    @staticmethod
+    def _split(fields):
+        fields = dict(fields)
+        results = fields.pop('results', None)
+        return fields.pop('status', None), fields.pop('progress', None), fields, results
+
+    def create(self, job_id, fields):
+        status, progress, rest, results = self._split(fields)
+        finished_at = time.time() if status in FINISHED_STATUSES else None
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO jobs (job_id, status, progress, fields, results, updated_at, finished_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_id, status, progress, _dumps(rest),
+                 zlib.compress(_dumps(results).encode()) if results is not None else None, time.time(), finished_at))
+        self._notify(job_id)
+
+    def update(self, job_id, fields):
+        status, progress, rest, results = self._split(fields)
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute('SELECT fields FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if row is None:
+                conn.execute('INSERT INTO jobs (job_id, fields, updated_at) VALUES (?, ?, ?)', (job_id, '{}', now))
+                merged = rest
+            else:
+                merged = json.loads(row[0])
+                merged.update(rest)
+            conn.execute(
+                'UPDATE jobs SET status = COALESCE(?, status), progress = COALESCE(?, progress), fields = ?, '
+                'results = COALESCE(?, results), updated_at = ?, version = version + 1, '
+                'finished_at = CASE WHEN ? THEN ? ELSE finished_at END WHERE job_id = ?',
+                (status, progress, _dumps(merged),
+                 zlib.compress(_dumps(results).encode()) if results is not None else None, now,
+                 status in FINISHED_STATUSES, now, job_id))
+        self._notify(job_id)
+        self._maybe_expire(now)
+
+    def get(self, job_id):
+        # Plain read: in WAL mode it sees the last commit without blocking or being blocked by writers
+        row = self._conn().execute('SELECT status, progress, fields, results FROM jobs WHERE job_id = ?',
+                                   (job_id,)).fetchone()
+        if row is None:
+            return None
+        status, progress, fields, results = row
+        job = json.loads(fields)
+        if status is not None:
+            job['status'] = status
+        if progress is not None:
+            job['progress'] = progress
+        if results is not None:
+            job['results'] = json.loads(zlib.decompress(results))
+        return job
+
+    def version(self, job_id):
+        row = self._conn().execute('SELECT version FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def delete(self, job_id):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+        self._notify(job_id)
+
+    def expire(self):
+        self._last_expire = time.time()
+        with self._transaction() as conn:
+            deleted = conn.execute('DELETE FROM jobs WHERE finished_at < ?',
+                                   (self._last_expire - self.ttl_seconds,)).rowcount
+        if deleted:
+            print(f"🧹 Expired {deleted} finished job(s) from the job store.")
+        return deleted
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK around a block on an autocommit connection."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+
+def open_job_store(url=None, ttl_seconds=None):
+    """Job store from a URL, by default NEUROSCOPE_JOB_STORE or DEFAULT_JOB_STORE_URL."""
+    url = url or os.environ.get('NEUROSCOPE_JOB_STORE', DEFAULT_JOB_STORE_URL)
+    if ttl_seconds is None:
+        ttl_seconds = float(os.environ.get('NEUROSCOPE_JOB_TTL_HOURS', DEFAULT_TTL_SECONDS / 3600)) * 3600
+    if url.startswith('memory://'):
+        return MemoryJobStore(ttl_seconds)
+    if url.startswith('sqlite:///'):
+        return SQLiteJobStore(url[len('sqlite:///'):], ttl_seconds)
+    raise ValueError(f"Unsupported job store URL: {url!r}")
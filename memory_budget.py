@@ -0,0 +1,59 @@
+# ==============================================================================
+# === memory_budget.py (Per-job memory reporting and enforcement) ==============
+# ==============================================================================
+import os
+import resource
+
+import numpy as np
+
+
+def current_rss_mb():
+    """Resident set size of this process in MB (Linux /proc, falls back to the peak RSS)."""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def array_mb(shape, dtype):
+    """Size in MB of one array of the given shape and dtype."""
+    return int(np.prod(shape)) * np.dtype(dtype).itemsize / 1024 ** 2
+
+
+class MemoryBudget:
+    """
+    Tracks the RSS growth of one job against an optional budget in MB.
+
+    The baseline is taken when the budget is created, so other jobs already
+    resident in the process are not charged to this one. require() rejects a
+    stage up front from an estimate, check() measures after a stage finished.
+    """
+
+    def __init__(self, budget_mb=None, label='job'):
+        self.budget_mb = budget_mb
+        self.label = label
+        self.baseline_mb = current_rss_mb()
+        self.peak_mb = 0.0
+
+    def require(self, estimated_mb, stage):
+        if self.budget_mb is not None and estimated_mb > self.budget_mb:
+            raise MemoryError(
+                f"[{self.label}] Stage '{stage}' needs an estimated {estimated_mb:.0f} MB, "
+                f"over the {self.budget_mb:.0f} MB budget.")
+
+    def check(self, stage):
+        used_mb = current_rss_mb() - self.baseline_mb
+        self.peak_mb = max(self.peak_mb, used_mb)
+        print(f"🧮 [{self.label}] {stage}: {used_mb:.0f} MB above baseline (peak {self.peak_mb:.0f} MB)")
+        if self.budget_mb is not None and used_mb > self.budget_mb:
+            raise MemoryError(
+                f"[{self.label}] Memory budget exceeded after '{stage}': "
+                f"{used_mb:.0f} MB used, budget {self.budget_mb:.0f} MB.")
+        return used_mb
+
+    def report(self):
+        budget = 'none' if self.budget_mb is None else f"{self.budget_mb:.0f} MB"
+        print(f"🧮 [{self.label}] Peak memory above baseline: {self.peak_mb:.0f} MB (budget: {budget})")
+        return {'peak_mb': self.peak_mb, 'budget_mb': self.budget_mb}
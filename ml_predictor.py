@@ -1,11 +1,25 @@
 # ==============================================================================
 # === ml_predictor.py (Revised with Data Scaling Fix) ==========================
 # ==============================================================================
+import logging
+import threading
+
 import joblib
 import numpy as np
+import pandas as pd
+
+import startup
+
+# Per-prediction debug output (raw/scaled feature values) is logged at DEBUG level
+logger = logging.getLogger(__name__)
+
+# The models were trained on the standard NiLearn pipeline (fmri_processing.STANDARD_FEATURE_DEFINITION)
+MODEL_FEATURE_DEFINITION = 'standard'
 
 # This dictionary will hold all loaded models and their configurations
 LOADED_MODELS = {}
+_models_lock = threading.Lock()
+_models_loaded = False
 
 # --- Central configuration for all diseases (No changes here) ---
 DISEASE_CONFIG = {
@@ -30,9 +44,11 @@ DISEASE_CONFIG = {
 }
 
 
+N_ROIS = 264
+TOTAL_FEATURES = N_ROIS * 4
+
+
 def _get_feature_indices_from_names(feature_names_list):
-    N_ROIS = 264;
-    TOTAL_FEATURES = N_ROIS * 4
     if feature_names_list == 'all': return list(range(TOTAL_FEATURES))
     type_offsets = {'SaEn': 0, 'DiffEn': N_ROIS, 'FuEn': N_ROIS * 2, 'RaEn': N_ROIS * 3}
     indices = []
@@ -55,7 +71,8 @@ def load_all_models():
     print("--- Loading all available ML models and scalers ---")
     for key, config in DISEASE_CONFIG.items():
         try:
-            prediction_package = joblib.load(config['model_path'])
+            with startup.timed('model', config['model_path']):
+                prediction_package = joblib.load(config['model_path'])
 
             # --- NEW: Check if the loaded file is the correct package format ---
             if not isinstance(prediction_package,
@@ -85,43 +102,108 @@ def load_all_models():
             print(f"🚨 ERROR loading package for '{key.upper()}': {e}")
 
 
-def run_ml_prediction(all_features, disease_key):
+def ensure_models_loaded():
+    """Loads the model packages once per process, on the first call (thread-safe)."""
+    global _models_loaded
+    if not _models_loaded:
+        with _models_lock:
+            if not _models_loaded:
+                load_all_models()
+                _models_loaded = True
+    return LOADED_MODELS
+
+
+def parse_disease_keys(diseases):
     """
-    Selects features, SCALES them, and then runs the prediction.
+    'all', a disease key, a comma-separated string or a list of keys -> 'all' or a list
+    of known keys (duplicates dropped). Does not load any model.
     """
+    if isinstance(diseases, str):
+        diseases = diseases.split(',')
+    keys = []
+    for key in diseases:
+        key = str(key).strip().lower()
+        if key == 'all':
+            return 'all'
+        if key not in DISEASE_CONFIG:
+            raise ValueError(f"Unknown disease '{key}'. Choose from {sorted(DISEASE_CONFIG)} or 'all'.")
+        if key not in keys:
+            keys.append(key)
+    if not keys:
+        raise ValueError("No disease selected.")
+    return keys
+
+
+def resolve_disease_keys(diseases):
+    """Like parse_disease_keys, with 'all' expanded to every model in LOADED_MODELS."""
+    keys = parse_disease_keys(diseases)
+    if keys == 'all':
+        keys = list(ensure_models_loaded())
+        if not keys:
+            raise RuntimeError("No model package is loaded. Please check model files and format.")
+    return keys
+
+
+def required_feature_indices(disease_keys):
+    """
+    Union of the feature indices the given models read, sorted, or 'all' when that is
+    every feature (e.g. BPD). Raises RuntimeError if any of the models is not loaded,
+    so a job fails before the entropy stage instead of computing an empty plan.
+    """
+    indices = set()
+    for key in disease_keys:
+        indices.update(int(i) for i in _get_model_config(key)['feature_indices'])
+    return 'all' if len(indices) == TOTAL_FEATURES else sorted(indices)
+
+
+def run_multi_prediction(all_features, disease_keys):
+    """
+    Runs every requested model on the same feature vector. A model that is not
+    loaded gets an 'error' entry instead of failing the other diseases.
+    """
+    results = {}
+    for key in disease_keys:
+        try:
+            results[key] = run_ml_prediction(all_features, key)
+        except RuntimeError as e:
+            results[key] = {'error': str(e)}
+    return {'diseases': results}
+
+
+def _get_model_config(disease_key):
+    ensure_models_loaded()
     if disease_key not in LOADED_MODELS:
         raise RuntimeError(f"Model package for '{disease_key}' is not loaded. Please check model file and format.")
+    return LOADED_MODELS[disease_key]
 
-    model_config = LOADED_MODELS[disease_key]
-    model = model_config['model']
-    scaler = model_config['scaler']  # Get the scaler
-    required_indices = model_config['feature_indices']
-    class_names = model_config['class_names']
 
-    # Step 1: Select the correct feature subset
-    selected_features = all_features[required_indices]
+def _predict_proba(disease_key, feature_matrix):
+    """Feature selection, scaling and predict_proba for all rows of an (n x 1056) matrix at once."""
+    model_config = _get_model_config(disease_key)
 
-    # Reshape features to 2D array for the scaler and model
-    features_2d = selected_features.reshape(1, -1)
+    # Step 1: Select the correct feature subset
+    selected_features = feature_matrix[:, model_config['feature_indices']]
 
     # --- Step 2: Apply the loaded scaler ---
     # We use .transform() ONLY. We DO NOT use .fit() or .fit_transform() here.
-    scaled_features = scaler.transform(features_2d)
-
-    # --- UPDATED DEBUGGING LOGS ---
-    print("\n" + "=" * 50)
-    print("--- DEBUGGING ML PREDICTION STEP ---")
-    print(f"Model selected: For disease '{disease_key.upper()}'")
-    print("First 5 RAW selected feature values (before scaling):")
-    print(features_2d[0, :5])
-    print("\nFirst 5 SCALED feature values being sent to the model:")
-    print(scaled_features[0, :5])
-    print("--- END DEBUG LOG ---")
-    print("=" * 50 + "\n")
-    # --- END OF DEBUGGING LOGS ---
+    scaled_features = model_config['scaler'].transform(selected_features)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("ML prediction for '%s' (%d subject(s)): first 5 raw selected features %s, "
+                     "first 5 scaled features %s", disease_key.upper(), len(feature_matrix),
+                     selected_features[0, :5], scaled_features[0, :5])
 
     # Step 3: Get prediction probabilities using the SCALED data
-    probabilities = model.predict_proba(scaled_features)[0]
+    return model_config['model'].predict_proba(scaled_features)
+
+
+def run_ml_prediction(all_features, disease_key):
+    """
+    Selects features, SCALES them, and then runs the prediction.
+    """
+    class_names = _get_model_config(disease_key)['class_names']
+    # Reshape features to 2D array for the scaler and model
+    probabilities = _predict_proba(disease_key, np.asarray(all_features).reshape(1, -1))[0]
     primary_diagnosis = class_names[np.argmax(probabilities)]
 
     # Step 4: Return the results
@@ -133,3 +215,52 @@ def run_ml_prediction(all_features, disease_key):
             class_names[1].lower(): probabilities[1] * 100
         }
     }
+
+
+# === BATCH PREDICTION (cohorts of stored feature vectors) ===
+def _as_feature_matrix(features):
+    """(n_subjects x 1056) float matrix and row labels from an array or a feature table."""
+    if isinstance(features, pd.DataFrame):
+        if 'feature_definition' in features.columns:
+            other = set(features['feature_definition']) - {MODEL_FEATURE_DEFINITION}
+            if other:
+                raise ValueError(f"The models were trained on '{MODEL_FEATURE_DEFINITION}' features; "
+                                 f"this table holds {sorted(other)} features.")
+        # Columns are picked by name, so their order and any extra columns (subject id, file name, ...) do not matter
+        from entropy_calculator import feature_column_names
+
+        names = feature_column_names()
+        missing = [name for name in names if name not in features.columns]
+        if missing:
+            raise ValueError(f"Feature table is missing {len(missing)} of {len(names)} feature columns "
+                             f"(e.g. {', '.join(missing[:3])}).")
+        matrix, index = features[names].to_numpy(dtype=np.float64), features.index
+    else:
+        matrix = np.atleast_2d(np.asarray(features, dtype=np.float64))
+        index = pd.RangeIndex(len(matrix))
+    if matrix.ndim != 2 or matrix.shape[1] != TOTAL_FEATURES:
+        raise ValueError(f"Expected {TOTAL_FEATURES} feature columns (ROI-major per entropy type), "
+                         f"got an array of shape {matrix.shape}.")
+    return matrix, index
+
+
+def predict_batch(features, diseases='all'):
+    """
+    Predicts a whole cohort: features is an (n_subjects x 1056) array or a
+    feature table (rows = subjects, e.g. stacked entropy_features.csv files)
+    whose feature columns are named as in entropy_calculator.feature_column_names().
+    Each model runs feature selection, scaling and predict_proba once for all rows.
+
+    Returns a DataFrame with the input's row index and, per disease, the columns
+    '<disease>_diagnosis' and '<disease>_<class>' (probabilities in percent).
+    Requested models that are not loaded raise RuntimeError.
+    """
+    matrix, index = _as_feature_matrix(features)
+    table = pd.DataFrame(index=index)
+    for key in resolve_disease_keys(diseases):
+        class_names = _get_model_config(key)['class_names']
+        probabilities = _predict_proba(key, matrix)
+        table[f"{key}_diagnosis"] = np.asarray(class_names, dtype=object)[np.argmax(probabilities, axis=1)]
+        for idx, name in enumerate(class_names):
+            table[f"{key}_{name.lower()}"] = probabilities[:, idx] * 100
+    return table
@@ -0,0 +1,91 @@
+# ==============================================================================
+# === resources.py (Offline atlas / template bundle, loaded lazily) ============
+# ==============================================================================
+import csv
+import functools
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+
+# The bundle ships with the repo; NEUROSCOPE_RESOURCE_DIR points to another copy (e.g. on shared storage)
+RESOURCE_DIR = os.environ.get('NEUROSCOPE_RESOURCE_DIR',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources'))
+
+POWER_COORDS_FILE = 'power_2011_coords.csv'
+MNI152_TEMPLATE_3MM_FILE = 'mni152_template_3mm.nii.gz'
+MNI152_BRAIN_MASK_3MM_FILE = 'mni152_brain_mask_3mm.nii.gz'
+
+
+def _resource_path(filename):
+    path = os.path.join(RESOURCE_DIR, filename)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"Resource '{filename}' not found in {RESOURCE_DIR}. "
+            f"Build the bundle with 'python resources.py' on a machine with nilearn's data available.")
+    return path
+
+
+def _load_image(filename):
+    """Reads the image fully into memory so later calls never touch the disk again."""
+    img = nib.load(_resource_path(filename))
+    return nib.Nifti1Image(np.asanyarray(img.dataobj), img.affine, img.header)
+
+
+@functools.lru_cache(maxsize=None)
+def get_atlas_coords():
+    """Power 2011 ROI centres (MNI mm) as a tuple of 264 (x, y, z) tuples."""
+    with open(_resource_path(POWER_COORDS_FILE), newline='') as f:
+        rows = sorted(csv.DictReader(f), key=lambda row: int(row['roi']))
+    return tuple((int(row['x']), int(row['y']), int(row['z'])) for row in rows)
+
+
+@functools.lru_cache(maxsize=None)
+def get_mni152_template_3mm():
+    """MNI152 template at 3 mm, the target grid of the NiLearn resampling stage."""
+    return _load_image(MNI152_TEMPLATE_3MM_FILE)
+
+
+@functools.lru_cache(maxsize=None)
+def get_mni152_brain_mask_3mm():
+    """MNI152 brain mask on the same 3 mm grid as get_mni152_template_3mm()."""
+    return _load_image(MNI152_BRAIN_MASK_3MM_FILE)
+
+
+def build_bundle(resource_dir=RESOURCE_DIR):
+    """Writes the bundle from nilearn's datasets; the only place anything is fetched."""
+    from nilearn import datasets
+
+    os.makedirs(resource_dir, exist_ok=True)
+
+    power = datasets.fetch_coords_power_2011()
+    coords_path = os.path.join(resource_dir, POWER_COORDS_FILE)
+    with open(coords_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['roi', 'x', 'y', 'z'])
+        for row in power.rois:
+            writer.writerow([int(row['roi']), int(row['x']), int(row['y']), int(row['z'])])
+    print(f"✅ {len(power.rois)} Power 2011 coordinates -> {coords_path}")
+
+    for filename, img in ((MNI152_TEMPLATE_3MM_FILE, datasets.load_mni152_template(resolution=3)),
+                          (MNI152_BRAIN_MASK_3MM_FILE, datasets.load_mni152_brain_mask(resolution=3))):
+        path = os.path.join(resource_dir, filename)
+        img.to_filename(path)
+        print(f"✅ {filename} {img.shape} -> {path}")
+
+    # Derived: the Power sphere-averaging operator on the template grid (what every processed image is on)
+    import sphere_operator
+    from entropy_calculator import ATLAS_RADIUS
+
+    template = nib.load(os.path.join(resource_dir, MNI152_TEMPLATE_3MM_FILE))
+    coords = tuple((int(row['x']), int(row['y']), int(row['z'])) for row in sorted(power.rois, key=lambda row: row['roi']))
+    key = sphere_operator.operator_key(template.shape, template.affine, ATLAS_RADIUS, coords)
+    operator = sphere_operator.build_sphere_operator(template.shape, template.affine, ATLAS_RADIUS, coords)
+    path = os.path.join(resource_dir, sphere_operator.operator_filename(key))
+    sphere_operator.save_sphere_operator(operator, path)
+    print(f"✅ Sphere operator {operator.shape}, {operator.nnz} voxels -> {path}")
+
+
+if __name__ == '__main__':
+    build_bundle(sys.argv[1] if len(sys.argv) > 1 else RESOURCE_DIR)
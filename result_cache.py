@@ -0,0 +1,106 @@
+# ==============================================================================
+# === result_cache.py (Content-addressed cache for pipeline results) ===========
+# ==============================================================================
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+# Bump whenever a change in fmri_processing / entropy_calculator alters the numbers,
+# so results cached by an older version are never served again.
+PIPELINE_VERSION = '3'
+
+DEFAULT_CACHE_DIR = 'cache/results'
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+HASH_CHUNK_BYTES = 8 * 1024 ** 2
+
+# (path, size, mtime_ns) -> sha256, so an unchanged file is hashed once per process
+_file_hash_memo = {}
+
+
+def file_sha256(path):
+    """Streaming SHA-256 of a file, memoized on its size and modification time."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hash_memo:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+                digest.update(chunk)
+        _file_hash_memo[memo_key] = digest.hexdigest()
+    return _file_hash_memo[memo_key]
+
+
+def make_cache_key(input_hashes, params):
+    """Key = SHA-256 over the input content hashes, the processing parameters and PIPELINE_VERSION."""
+    payload = json.dumps({'inputs': list(input_hashes), 'params': params, 'version': PIPELINE_VERSION},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of the ROI timeseries and the 1056-feature vector, one .npz per key.
+
+    Entries are written atomically (temp file + os.replace), a hit refreshes the
+    entry's mtime, and whenever the total size goes over max_bytes the least
+    recently used entries are deleted.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npz")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as cached:
+                entry = {name: cached[name] for name in cached.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        try:
+            os.utime(path)  # LRU: mark as recently used
+        except OSError:
+            pass
+        entry['metadata'] = json.loads(str(entry['metadata']))
+        return entry
+
+    def put(self, key, features, timeseries_std, timeseries_raw, metadata=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, features=np.asarray(features), timeseries_std=np.asarray(timeseries_std),
+                     timeseries_raw=np.asarray(timeseries_raw), metadata=json.dumps(metadata or {}, default=str))
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for root, _, files in os.walk(self.cache_dir):
+                for name in files:
+                    if name.endswith('.npz'):
+                        full = os.path.join(root, name)
+                        try:
+                            stat = os.stat(full)
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, full))
+            total = sum(size for _, size, _ in entries)
+            for _, size, full in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(full)
+                    total -= size
+                    print(f"🧹 Evicted cached result: {os.path.basename(full)}")
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,133 @@
+# ==============================================================================
+# === sphere_operator.py (Cached sparse sphere-averaging operator) =============
+# ==============================================================================
+import functools
+import hashlib
+import json
+import os
+import threading
+from importlib import metadata
+
+import nibabel as nib
+import numpy as np
+from scipy import sparse
+
+import resources
+
+# Operators built at runtime are written here; the one for the bundled 3mm template grid ships in resources/
+OPERATOR_CACHE_DIR = os.environ.get('NEUROSCOPE_OPERATOR_DIR', 'cache/operators')
+# Bump if the way the operator is built changes
+OPERATOR_VERSION = '1'
+
+
+@functools.lru_cache(maxsize=None)
+def nilearn_version():
+    # Sphere membership comes from a private nilearn helper, so its version is part of the operator key
+    return metadata.version('nilearn')
+
+_operator_lock = threading.Lock()
+# key -> CSR operator, for the process lifetime
+_operators = {}
+
+
+def operator_key(grid_shape, affine, radius, coords):
+    """SHA-256 over the grid geometry, the sphere radius, the seed coordinates and the nilearn version."""
+    payload = json.dumps({
+        'shape': [int(n) for n in grid_shape[:3]],
+        'affine': np.round(np.asarray(affine, dtype=np.float64), 6).tolist(),
+        'radius': float(radius),
+        'coords': [[float(c) for c in xyz] for xyz in coords],
+        'version': OPERATOR_VERSION,
+        'nilearn': nilearn_version(),
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def operator_filename(key):
+    return f"sphere_operator_{key}.npz"
+
+
+def build_sphere_operator(grid_shape, affine, radius, coords):
+    """
+    (ROI x voxels) CSR matrix whose row i averages the voxels of sphere i over the
+    C-order flattened grid. Voxel membership comes from the same nilearn routine
+    NiftiSpheresMasker uses (nearest voxel of the seed always included, overlapping
+    spheres rejected), so the operator reproduces the masker's sphere means.
+    """
+    from nilearn.maskers.nifti_spheres_masker import _apply_mask_and_get_affinity
+
+    # A single all-zero volume on the grid: only its geometry is used
+    reference = nib.Nifti1Image(np.zeros(tuple(grid_shape[:3]) + (1,), dtype=np.float32), affine)
+    _, adjacency = _apply_mask_and_get_affinity(list(coords), reference, radius, allow_overlap=False)
+    adjacency = adjacency.tocsr().astype(np.float64)
+    adjacency.data[:] = 1.0
+    sphere_sizes = np.asarray(adjacency.sum(axis=1)).ravel()
+    operator = sparse.diags(1.0 / sphere_sizes) @ adjacency
+    return operator.tocsr()
+
+
+def get_sphere_operator(grid_shape, affine, radius, coords=None, order='C'):
+    """
+    Returns the sphere-averaging operator for this grid, from (in order) the
+    in-process memo, the resource bundle, the operator cache directory, or a
+    fresh build that is then written to the cache directory. order='F' gives
+    its columns in Fortran voxel order (x fastest) instead of C order.
+    """
+    coords = resources.get_atlas_coords() if coords is None else coords
+    key = operator_key(grid_shape, affine, radius, coords)
+    if order == 'F':
+        return _fortran_order_operator(key, grid_shape, affine, radius, coords)
+    operator = _operators.get(key)
+    if operator is not None:
+        return operator
+
+    with _operator_lock:
+        if key in _operators:
+            return _operators[key]
+        filename = operator_filename(key)
+        for directory in (resources.RESOURCE_DIR, OPERATOR_CACHE_DIR):
+            path = os.path.join(directory, filename)
+            if os.path.exists(path):
+                operator = sparse.load_npz(path).tocsr()
+                break
+        else:
+            print(f"🔧 Building sphere operator for grid {tuple(grid_shape[:3])} ({len(coords)} spheres)...")
+            operator = build_sphere_operator(grid_shape, affine, radius, coords)
+            save_sphere_operator(operator, os.path.join(OPERATOR_CACHE_DIR, filename))
+        _operators[key] = operator
+    return operator
+
+
+def _fortran_order_operator(key, grid_shape, affine, radius, coords):
+    # The C-order operator with its columns permuted, memoized next to it
+    f_key = key + ':F'
+    operator = _operators.get(f_key)
+    if operator is None:
+        c_order = get_sphere_operator(grid_shape, affine, radius, coords)
+        c_index = np.arange(int(np.prod(grid_shape[:3]))).reshape(tuple(grid_shape[:3]))
+        operator = _operators[f_key] = c_order[:, c_index.ravel(order='F')].tocsr()
+    return operator
+
+
+def save_sphere_operator(operator, path):
+    """Atomic save_npz, so concurrent workers never read a half-written operator."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+    sparse.save_npz(tmp_path, operator)
+    os.replace(tmp_path, path)
+    return path
+
+
+def sphere_signals(img, radius, coords=None):
+    """(T x ROI) sphere means of a 4D image: one sparse product over the flattened voxels."""
+    data = np.asanyarray(img.dataobj)
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(np.float64)
+    if np.isnan(data).any():
+        data = np.nan_to_num(data)  # the masker also zeroes NaNs
+    # (x, y, z, T) -> (voxels x T) without a copy: nibabel's arrays are Fortran-ordered, so those are
+    # flattened in Fortran order and multiplied by the operator with its columns permuted to match
+    order = 'F' if data.flags.f_contiguous and not data.flags.c_contiguous else 'C'
+    operator = get_sphere_operator(img.shape, img.affine, radius, coords, order=order)
+    voxel_series = data.reshape(-1, data.shape[-1], order=order)  # copies only for non-contiguous arrays
+    return np.asarray(operator @ voxel_series).T
@@ -0,0 +1,87 @@
+# ==============================================================================
+# === startup.py (Lazy heavy imports, warm-up hook and startup profile) ========
+# ==============================================================================
+import importlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# NEUROSCOPE_EAGER_STARTUP=1: import everything and load the models while the app module loads
+# (production workers), instead of on the first request that needs them (development, autoreload)
+EAGER_STARTUP = os.environ.get('NEUROSCOPE_EAGER_STARTUP', '0') == '1'
+
+_PROCESS_START = time.perf_counter()
+_profile_lock = threading.Lock()
+# (kind, name, seconds) in the order they finished
+_profile = []
+
+
+@contextmanager
+def timed(kind, name):
+    """Records how long the block took in the startup profile."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _profile_lock:
+            _profile.append((kind, name, time.perf_counter() - start))
+
+
+class LazyModule:
+    """
+    Stands in for a module and imports it on first attribute access, e.g.
+    fmri_processing = LazyModule('fmri_processing'). Call sites stay unchanged.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    with timed('import', self._name):
+                        self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def is_loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self.is_loaded else 'not loaded'
+        return f"<LazyModule '{self._name}' ({state})>"
+
+
+def warm_up(lazy_modules=(), loaders=()):
+    """
+    Eager warm-up hook: imports the lazy modules and runs the (name, fn) loaders,
+    e.g. model loading, then prints the startup profile.
+    """
+    for module in lazy_modules:
+        module.load()
+    for name, loader in loaders:
+        with timed('load', name):
+            loader()
+    return report()
+
+
+def report():
+    """Prints and returns the startup profile: per-import / per-load seconds, slowest first."""
+    with _profile_lock:
+        entries = sorted(_profile, key=lambda entry: entry[2], reverse=True)
+    print("--- Startup profile ---")
+    for kind, name, seconds in entries:
+        print(f"⏱️ {kind:<6} {name:<32} {seconds:8.3f} s")
+    uptime = time.perf_counter() - _PROCESS_START
+    print(f"⏱️ Since startup module import: {uptime:.3f} s")
+    return {
+        'entries': [{'kind': kind, 'name': name, 'seconds': round(seconds, 4)} for kind, name, seconds in entries],
+        'uptime_seconds': round(uptime, 4),
+    }
@@ -0,0 +1,55 @@
+# ==============================================================================
+# === test_checkpoints.py (Stage checkpoints: resume, size cap, discard) =======
+# ==============================================================================
+import os
+
+import nibabel as nib
+import numpy as np
+
+import checkpoints
+
+
+def _image_stage(name, calls, checkpoint=True):
+    def compute(img):
+        calls.append(name)
+        return nib.Nifti1Image(np.asanyarray(img.dataobj) + 1, img.affine)
+
+    return checkpoints.Stage(name, {}, compute, 'image', checkpoint=checkpoint)
+
+
+def _initial_image():
+    return nib.Nifti1Image(np.zeros((8, 8, 8, 20), dtype=np.float32), np.eye(4))
+
+
+def _checkpoint_files(root):
+    return sorted(name for _, _, files in os.walk(root) for name in files)
+
+
+def test_only_marked_stages_are_written_compressed_and_resumed(tmp_path):
+    calls = []
+    stages = [_image_stage('cheap', calls, checkpoint=False), _image_stage('final', calls)]
+    chain = checkpoints.PipelineCheckpoints('inputs', root=str(tmp_path))
+    chain.run(stages, _initial_image)
+    files = _checkpoint_files(tmp_path)
+    assert len(files) == 1 and files[0].endswith('.nii.gz')
+
+    resumed = checkpoints.PipelineCheckpoints('inputs', root=str(tmp_path)).run(stages, _initial_image)
+    assert calls == ['cheap', 'final']
+    assert np.all(np.asanyarray(resumed.dataobj) == 2)
+
+
+def test_checkpoints_are_capped_and_discarded(tmp_path):
+    stages = [_image_stage('final', [])]
+    for idx in range(3):
+        chain = checkpoints.PipelineCheckpoints(f'inputs-{idx}', root=str(tmp_path))
+        chain.run(stages, _initial_image)
+        os.utime(chain._paths[0], (idx, idx))  # distinct ages for the LRU order
+    size = os.path.getsize(chain._paths[0])
+
+    # A cap of two checkpoints: writing a fourth evicts the two least recently used ones
+    chain = checkpoints.PipelineCheckpoints('inputs-3', root=str(tmp_path), max_bytes=2 * size)
+    chain.run(stages, _initial_image)
+    assert len(_checkpoint_files(tmp_path)) == 2
+
+    chain.discard()
+    assert len(_checkpoint_files(tmp_path)) == 1
@@ -0,0 +1,30 @@
+# ==============================================================================
+# === test_chunked_upload.py (Uploads never touch the manager's own files) =====
+# ==============================================================================
+import io
+import json
+import os
+
+import pytest
+
+import chunked_upload
+
+
+@pytest.mark.parametrize('filename', ['state.json', 'lock', 'data.part'])
+def test_client_file_names_cannot_overwrite_upload_state(tmp_path, filename):
+    manager = chunked_upload.UploadManager(str(tmp_path))
+    payload = b'not the state file'
+    upload = manager.create(filename, len(payload))
+    manager.write_chunk(upload['upload_id'], 0, io.BytesIO(payload), len(payload))
+    path, _, state = manager.complete(upload['upload_id'])
+
+    with open(path, 'rb') as f:
+        assert f.read() == payload
+    assert state['filename'] == filename and state['complete']
+    with open(os.path.join(str(tmp_path), upload['upload_id'], 'state.json')) as f:
+        assert json.load(f)['complete']
+    # Completing again still finds the file and the saved state
+    assert manager.complete(upload['upload_id'])[0] == path
+
+    path, _, _ = manager.save_stream(filename, io.BytesIO(payload))
+    assert os.path.basename(os.path.dirname(path)) == 'data'
@@ -0,0 +1,61 @@
+# ==============================================================================
+# === test_entropy_calculator.py (Feature CSV of a plan, dynamic entropy) ======
+# ==============================================================================
+import numpy as np
+import pandas as pd
+import pytest
+
+import entropy_calculator
+
+
+def test_partial_plan_csv_has_only_the_planned_columns(tmp_path):
+    features = np.arange(1056, dtype=np.float64)
+    planned = entropy_calculator.normalize_feature_indices([700, 3, 264])
+    path = entropy_calculator.save_entropy_features_csv(features, str(tmp_path), planned)
+
+    frame = pd.read_csv(path)
+    names = entropy_calculator.feature_column_names()
+    assert list(frame.columns) == [names[3], names[264], names[700]]
+    assert frame.iloc[0].tolist() == [3.0, 264.0, 700.0]
+    assert pd.read_csv(entropy_calculator.save_entropy_features_csv(features, str(tmp_path))).shape == (1, 1056)
+
+
+def _window_entropies(x_std, x_raw, r_std, r_raw, m=2, n=2):
+    # One window from scratch, with the full series' tolerances (as dynamic_entropy uses)
+    def templates(x, length, count):
+        return np.array([x[i:i + length] for i in range(count)])
+
+    def chebyshev(T):
+        return np.abs(T[:, None, :] - T[None, :, :]).max(axis=2)
+
+    n_templates = len(x_std) - m
+    upper = np.triu(np.ones((n_templates, n_templates), dtype=bool), 1)
+    B = np.count_nonzero((chebyshev(templates(x_std, m, n_templates)) < r_std) & upper)
+    A = np.count_nonzero((chebyshev(templates(x_std, m + 1, n_templates)) < r_std) & upper)
+    saen = -np.log(A / B) if A and B else (np.inf if B else np.nan)
+
+    def phi(length):
+        count = len(x_raw) - length + 1
+        return np.exp(-chebyshev(templates(x_raw, length, count)) ** n / r_raw).sum() / count ** 2
+
+    return saen, -np.log(phi(m + 1) / phi(m))
+
+
+@pytest.mark.parametrize('step', [1, 3])
+def test_incremental_dynamic_entropy_matches_recomputing_each_window(step):
+    rng = np.random.default_rng(0)
+    t = np.arange(60)[:, np.newaxis]
+    timeseries_raw = np.sin(t * np.array([0.3, 0.5, 0.9])) + 0.3 * rng.standard_normal((60, 3))
+    timeseries_std = (timeseries_raw - timeseries_raw.mean(axis=0)) / timeseries_raw.std(axis=0)
+    window, r_ratio = 25, 0.5  # every window has m and m + 1 matches, so all values are finite
+
+    dynamic = entropy_calculator.dynamic_entropy(timeseries_std, timeseries_raw, window, step=step, r_ratio=r_ratio)
+    starts = range(0, 60 - window + 1, step)
+    assert dynamic.shape == (len(starts), 3, len(entropy_calculator.DYNAMIC_ENTROPY_TYPES))
+    assert np.isfinite(dynamic).all()
+    for roi in range(3):
+        r_std = r_ratio * timeseries_std[:, roi].std()
+        r_raw = r_ratio * timeseries_raw[:, roi].std()
+        expected = np.array([_window_entropies(timeseries_std[s:s + window, roi], timeseries_raw[s:s + window, roi],
+                                               r_std, r_raw) for s in starts])
+        np.testing.assert_allclose(dynamic[:, roi, :], expected, rtol=1e-10, atol=1e-12)
@@ -0,0 +1,47 @@
+# ==============================================================================
+# === test_feature_store.py (Full and partial feature rows, v1 upgrade) ========
+# ==============================================================================
+import csv
+import json
+import os
+
+import numpy as np
+
+import feature_store
+
+
+def test_partial_rows_are_found_only_for_the_features_they_computed(tmp_path):
+    store = feature_store.FeatureStore(str(tmp_path), n_features=6)
+    full = np.arange(6, dtype=np.float64)
+    store.append(full, subject='a', content_hash='k')
+    store.append(full * 10, subject='b', content_hash='k', columns=[1, 3])
+
+    # Unplanned features are stored as NaN, planned ones bit-exact
+    partial = store.get(subject='b')
+    assert np.array_equal(partial[[1, 3]], [10.0, 30.0]) and np.isnan(partial[[0, 2, 4, 5]]).all()
+    assert store.find(content_hash='k', columns=[3, 1]) == [0, 1]
+    assert store.find(content_hash='k', columns=[0, 1]) == [0]
+    assert np.array_equal(store.get(content_hash='k', columns=[1]), partial, equal_nan=True)
+
+    # Another process (a fresh instance) sees the plan of the partial row
+    reopened = feature_store.FeatureStore(str(tmp_path), n_features=6)
+    frame = reopened.to_frame(column_names=[f"f{i}" for i in range(6)])
+    assert list(frame['plan']) == ['all', feature_store.FeatureStore.plan_id([3, 1])]
+    assert reopened.find(columns=[2]) == [0]
+
+
+def test_version_1_stores_are_upgraded_to_full_plan_rows(tmp_path):
+    root = str(tmp_path)
+    with open(os.path.join(root, 'meta.json'), 'w') as f:
+        json.dump({'n_features': 2, 'dtype': '<f8', 'version': 1}, f)
+    np.array([[1.0, 2.0]]).tofile(os.path.join(root, 'features.f64'))
+    with open(os.path.join(root, 'index.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['row', 'subject', 'job_id', 'content_hash', 'created_at'])
+        writer.writerow([0, 'old', '', 'k', '1.0'])
+
+    store = feature_store.FeatureStore(root, n_features=2)
+    store.append([3.0, 4.0], subject='new', columns='all')
+    assert [row['plan'] for row in store.index()] == ['all', 'all']
+    assert store.find(columns=[0, 1]) == [0, 1]
+    assert np.array_equal(store.read_matrix(), [[1.0, 2.0], [3.0, 4.0]])
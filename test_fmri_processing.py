@@ -0,0 +1,111 @@
+# ==============================================================================
+# === test_fmri_processing.py (cleaning, NiLearn stages, memory budget) ========
+# ==============================================================================
+import os
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+
+import checkpoints
+import entropy_calculator
+import fmri_processing
+import resources
+
+FMRIPREP_FUNC_FILES = [
+    'sub-01_ses-01_task-rest_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz',
+    'sub-01_ses-01_task-rest_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz',
+    'sub-01_ses-01_task-rest_space-T1w_desc-preproc_bold.nii.gz',
+    'sub-01_ses-01_task-rest_desc-confounds_timeseries.tsv',
+]
+
+
+def _fake_fmriprep_output(output_dir):
+    func_dir = os.path.join(output_dir, 'fmriprep', 'sub-01', 'ses-01', 'func')
+    os.makedirs(func_dir)
+    for name in FMRIPREP_FUNC_FILES:
+        with open(os.path.join(func_dir, name), 'wb') as f:
+            f.write(name.encode())
+
+
+def test_cleaned_fmriprep_output_is_found_by_nilearn_stage(tmp_path):
+    output_dir = str(tmp_path / 'outputs' / 'job')
+    _fake_fmriprep_output(output_dir)
+
+    cleaning = [stage for stage in fmri_processing.build_fmriprep_stages('job') if stage.name == 'cleaning']
+    chain = checkpoints.PipelineCheckpoints('upload-hash', root=str(tmp_path / 'checkpoints'))
+    clean_dir = checkpoints.run_stages(cleaning, lambda: output_dir, checkpoints=chain)
+
+    bold_path, confounds_path = fmri_processing.find_input_files(clean_dir)
+    assert os.path.basename(bold_path) == FMRIPREP_FUNC_FILES[0]
+    assert os.path.basename(confounds_path) == FMRIPREP_FUNC_FILES[3]
+    assert not os.path.exists(os.path.join(clean_dir, FMRIPREP_FUNC_FILES[2]))
+
+
+def test_hand_prepared_folder_names_are_still_found(tmp_path):
+    for name in ('sub-01_preproc_bold.nii.gz', 'sub-01_confounds_timeseries.tsv'):
+        (tmp_path / name).write_bytes(b'')
+    bold_path, confounds_path = fmri_processing.find_input_files(str(tmp_path))
+    assert bold_path.endswith('sub-01_preproc_bold.nii.gz')
+    assert confounds_path.endswith('sub-01_confounds_timeseries.tsv')
+
+
+def _synthetic_run(n_timepoints=40):
+    rng = np.random.default_rng(0)
+    data = np.zeros((12, 10, 8, n_timepoints))
+    data[3:9, 2:8, 2:6] = rng.standard_normal((6, 6, 4, n_timepoints)) + 100
+    confounds = pd.DataFrame(rng.standard_normal((n_timepoints, 8)),
+                             columns=['X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ', 'WhiteMatter', 'GlobalSignal'])
+    confounds['FramewiseDisplacement'] = np.where(np.arange(n_timepoints) % 9 == 4, 0.5, 0.05)
+    return nib.Nifti1Image(data, np.diag([3.0, 3.0, 3.0, 1.0])), confounds
+
+
+def test_brain_mask_regression_matches_the_standard_stages():
+    img, confounds = _synthetic_run()
+    template = nib.Nifti1Image(np.zeros((6, 5, 4)), np.diag([6.0, 6.0, 6.0, 1.0]))
+
+    standard = fmri_processing.build_nilearn_stages('.', confounds, 2.0, template)
+    masked = fmri_processing.build_nilearn_stages('.', confounds, 2.0, template, use_brain_mask=True)
+    # Scrubbing + regression; resampling, smoothing and band-pass are the same stages in both
+    assert [stage.name for stage in standard[2:]] == [stage.name for stage in masked[1:]]
+    expected = checkpoints.run_stages(standard[:2], lambda: img).get_fdata()
+    np.testing.assert_allclose(checkpoints.run_stages(masked[:1], lambda: img).get_fdata(), expected,
+                               rtol=0, atol=1e-9)
+
+
+def _write_mni_run(input_dir, n_timepoints=60):
+    template = resources.get_mni152_template_3mm()
+    rng = np.random.default_rng(1)
+    in_brain = np.asarray(template.dataobj)[..., np.newaxis] > 0
+    data = (rng.standard_normal(template.shape[:3] + (n_timepoints,)) + 100).astype(np.float32) * in_brain
+    nib.Nifti1Image(data, template.affine).to_filename(str(input_dir / 'sub-01_desc-preproc_bold.nii.gz'))
+    confounds = pd.DataFrame(rng.standard_normal((n_timepoints, 8)),
+                             columns=['X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ', 'WhiteMatter', 'GlobalSignal'])
+    confounds['FramewiseDisplacement'] = 0.05
+    confounds.to_csv(input_dir / 'sub-01_desc-confounds_timeseries.tsv', sep='\t', index=False)
+
+
+def test_float32_pipeline_runs_under_a_small_memory_budget(tmp_path):
+    _write_mni_run(tmp_path)
+    budget_mb = 256
+    assert entropy_calculator.max_block_bytes_for_budget(budget_mb) < entropy_calculator.DEFAULT_MAX_BLOCK_BYTES
+
+    img = fmri_processing.run_nilearn_processing(str(tmp_path), 'budget', dtype=np.float32,
+                                                 memory_budget_mb=budget_mb, save_output=None, return_img=True)
+    features = entropy_calculator.calculate_entropy_features(img, dtype=np.float32, memory_budget_mb=budget_mb)
+    assert features.shape == (4 * entropy_calculator.N_ROIS,)
+    assert np.isfinite(features).all()
+
+    with pytest.raises(MemoryError):
+        fmri_processing.run_nilearn_processing(str(tmp_path), 'budget', dtype=np.float32, memory_budget_mb=16,
+                                               save_output=None, return_img=True)
+
+
+def test_smaller_entropy_blocks_give_the_same_features():
+    rng = np.random.default_rng(2)
+    raw = rng.standard_normal((80, entropy_calculator.N_ROIS))
+    std = (raw - raw.mean(axis=0)) / raw.std(axis=0)
+    expected = entropy_calculator.compute_entropy_features(std, raw)
+    chunked = entropy_calculator.compute_entropy_features(std, raw, max_block_bytes=64 * 1024)
+    np.testing.assert_allclose(chunked, expected, rtol=1e-12, atol=0)
@@ -0,0 +1,38 @@
+# ==============================================================================
+# === test_job_store.py (Job stores seen from the app and job processes) =======
+# ==============================================================================
+import multiprocessing
+
+import job_store
+
+
+def _read_in_child(store, job_id, results):
+    try:
+        results.put(('ok', store.get(job_id)))
+    except RuntimeError as e:
+        results.put(('error', str(e)))
+
+
+def _read_from_forked_process(store, job_id):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    process = context.Process(target=_read_in_child, args=(store, job_id, results))
+    process.start()
+    outcome = results.get(timeout=30)
+    process.join()
+    return outcome
+
+
+def test_sqlite_store_is_shared_with_job_processes(tmp_path):
+    store = job_store.open_job_store(f"sqlite:///{tmp_path / 'jobs.db'}")
+    store.create('job', {'status': 'queued', 'filepath': '/uploads/a/scan.nii.gz'})
+    assert _read_from_forked_process(store, 'job') == ('ok', {'status': 'queued',
+                                                               'filepath': '/uploads/a/scan.nii.gz'})
+
+
+def test_memory_store_refuses_other_processes():
+    store = job_store.open_job_store('memory://')
+    store.create('job', {'status': 'queued'})
+    status, message = _read_from_forked_process(store, 'job')
+    assert status == 'error' and 'memory://' in message
+    assert store.get('job') == {'status': 'queued'}